@@ -24,12 +24,15 @@ import venvpool
 loadtime = time.time() - mark
 assert venvpoolname in sys.modules
 
+from base64 import urlsafe_b64encode
+from contextlib import contextmanager
+from hashlib import sha256
 from multiprocessing import cpu_count
 from pkg_resources import parse_requirements # Expensive module!
 from tempfile import mkstemp
 from unittest import TestCase
-from venvpool import _chunkify, _compress, _decompress, Execute, FastReq, listorempty, LockStateException, oserrors, _osop, ReadLock, TemporaryDirectory, Venv
-import errno, inspect, operator, os, subprocess
+from venvpool import _chunkify, Compact, _compress, _decompress, Evict, Execute, FastReq, Launch, listorempty, LockStateException, oserrors, _osop, ParsedRequires, Pool, ReadLock, Resolution, TemporaryDirectory, Venv, _versionkey, WheelStore
+import errno, inspect, logging, operator, os, py_compile, re, socket, subprocess, threading
 
 def _inherithandle(tempdir):
     from signal import SIGINT
@@ -65,6 +68,45 @@ class TestVenvPool(TestCase):
                 return
         self.assertTrue(expr(loadtime, operator.lt, .01))
 
+    def test_stubload(self):
+        def loadtime(code):
+            return min(float(subprocess.check_output([sys.executable, '-c', "import sys, time\nmark = time.time()\n%s\nsys.stdout.write(repr(time.time() - mark))" % code])) for _ in range(5))
+        path = venvpool.__file__
+        if path.endswith('.pyc'):
+            path = path[:-1]
+        py_compile.compile(path, doraise = True) # As done by install.
+        exectime = loadtime("with open(%r) as f: src = f.read()\nexec(src, dict(__file__ = %r, __name__ = 'stub'))" % (path, path))
+        compiledtime = loadtime("sys.path.insert(0, %r)\nimport venvpool" % os.path.dirname(os.path.dirname(path)))
+        sys.stderr.write("%s < %s ... " % (compiledtime, exectime)) # Reported only, timing is too noisy to assert.
+        if sys.version_info.major < 3:
+            cachepath = path + 'c'
+        else:
+            from importlib.util import cache_from_source
+            cachepath = cache_from_source(path)
+        self.assertTrue(os.path.exists(cachepath))
+
+    def test_installstub(self):
+        from venvpool import Activate
+        def read():
+            with open(scriptpath) as f:
+                return f.read()
+        with TemporaryDirectory() as tempdir:
+            userbin = venvpool.userbin
+            venvpool.userbin = tempdir
+            try:
+                scriptpath = os.path.join(tempdir, 'cmd')
+                Activate.install(False, False, 'cmd', 3, None, 'cmd.py')
+                self.assertIn('exec(venvpoolsrc)', read())
+                Activate.install(False, True, 'cmd', 3, None, 'cmd.py') # Our own stub, so no need to force.
+                self.assertIn('import venvpool\n', read())
+                self.assertNotIn('exec(', read())
+                with open(scriptpath, 'w') as f:
+                    f.write('mine')
+                Activate.install(False, True, 'cmd', 3, None, 'cmd.py')
+                self.assertEqual('mine', read())
+            finally:
+                venvpool.userbin = userbin
+
     def test_oserrors(self):
         with TemporaryDirectory() as tempdir:
             try:
@@ -88,6 +130,71 @@ class TestVenvPool(TestCase):
             except OSError:
                 pass
 
+    def test_fcntlshareddir(self):
+        from venvpool import FcntlSharedDir
+        with TemporaryDirectory() as tempdir:
+            d = FcntlSharedDir(tempdir)
+            self.assertFalse(d.trywritelock())
+            self.assertIsNone(d.tryreadlock())
+            d.writeunlock()
+            with self.assertRaises(LockStateException):
+                d.writeunlock()
+            locks = [d.tryreadlock(), d.tryreadlock()]
+            self.assertEqual(2, d.readlockcount())
+            self.assertFalse(d.trywritelock())
+            for lock in locks:
+                lock.unlock()
+            self.assertEqual(0, d.readlockcount())
+            self.assertTrue(d.trywritelock())
+            self.assertIsNone(d.tryreadlock())
+            self.assertFalse(FcntlSharedDir(tempdir).trywritelock())
+            d.writeunlock()
+            child = subprocess.Popen([sys.executable, '-c', "import sys\nsys.path.insert(0, %r)\nfrom venvpool import FcntlSharedDir\nFcntlSharedDir(%r).tryreadlock()\nprint('locked')\nsys.stdout.flush()\nsys.stdin.read()" % (os.path.dirname(os.path.dirname(venvpool.__file__)), tempdir)], stdin = subprocess.PIPE, stdout = subprocess.PIPE)
+            try:
+                self.assertEqual(b'locked\n', child.stdout.readline())
+                self.assertFalse(d.trywritelock())
+            finally:
+                child.kill()
+                child.wait()
+                child.stdin.close()
+                child.stdout.close()
+            self.assertTrue(d.trywritelock()) # Released by the kernel.
+
+    def test_lockbackend(self):
+        from venvpool import FcntlSharedDir, SharedDir
+        class FakePool(Pool):
+            def _create(self, venv):
+                os.makedirs(os.path.join(venv.venvpath, 'lib', 'python3.x', 'site-packages'))
+        with _temppool() as pooldir:
+            self.assertIsInstance(Venv(os.path.join(pooldir, 'x')).shareddir, SharedDir) # Not recorded yet.
+            os.environ['VENVPOOL_LOCKS'] = 'fcntl'
+            try:
+                with FakePool(3).readonly(ParsedRequires([])) as venv:
+                    pass
+                with open(os.path.join(pooldir, 'locks')) as f:
+                    self.assertEqual('fcntl', f.read())
+                os.environ['VENVPOOL_LOCKS'] = 'readlocks'
+                with self.assertRaises(ValueError):
+                    Venv(venv.venvpath)
+            finally:
+                del os.environ['VENVPOOL_LOCKS']
+            self.assertIsInstance(Venv(venv.venvpath).shareddir, FcntlSharedDir)
+            self.assertTrue(Venv(venv.venvpath).trywritelock())
+        with _temppool() as pooldir:
+            Venv(os.path.join(pooldir, 'x'))
+            self.assertIsNone(venvpool._lockbackends[pooldir]) # No record is cached too.
+            venv = _fakevenv(os.path.join(pooldir, '3', 'venv1'))
+            venv.writeunlock()
+            del venvpool._lockbackends[pooldir]
+            os.environ['VENVPOOL_LOCKS'] = 'fcntl'
+            try:
+                with self.assertRaises(ValueError): # Existing venvs use readlocks.
+                    Venv(venv.venvpath)
+            finally:
+                del os.environ['VENVPOOL_LOCKS']
+            with open(os.path.join(pooldir, 'locks')) as f:
+                self.assertEqual('readlocks', f.read())
+
     def test_listorempty(self):
         with TemporaryDirectory() as tempdir:
             d = os.path.join(tempdir, 'woo')
@@ -113,6 +220,74 @@ class TestVenvPool(TestCase):
                 f.write('import sys\nprint(sys.modules[__name__].__file__)')
             self.assertEqual(scriptpath + '\n', Venv(os.path.dirname(os.path.dirname(sys.executable))).run('check_output', [tempdir], 'module_name', [], universal_newlines = True))
 
+    def test_trampoline(self):
+        with TemporaryDirectory() as tempdir:
+            venv = _fakevenv(os.path.join(tempdir, 'venv'))
+            os.mkdir(os.path.join(venv.venvpath, 'bin'))
+            os.symlink(sys.executable, venv.programpath('python'))
+            trampolinepath = os.path.join(venv.site_packages, venvpool.trampolinerelpath)
+            os.mkdir(os.path.dirname(trampolinepath))
+            with open(trampolinepath, 'w') as f:
+                f.write(venvpool._trampolinesrc())
+            scriptpath = os.path.join(tempdir, 'module_name.py')
+            with open(scriptpath, 'w') as f:
+                f.write("import sys\nprint(sys.argv)\nprint('logging' in sys.modules)") # Logging is imported by venvpool proper.
+            self.assertEqual([str([scriptpath, 'yay']), 'False'], venv.run('check_output', [tempdir], 'module_name', ['yay'], universal_newlines = True).splitlines())
+
+    def test_zygote(self):
+        if sys.version_info.major < 3: # Launch does not use the zygote there.
+            return
+        def waitfor(condition):
+            for _ in range(100):
+                if condition():
+                    return
+                time.sleep(.1)
+            self.fail()
+        with TemporaryDirectory() as tempdir:
+            venv = Venv(os.path.join(tempdir, 'venv'))
+            os.makedirs(os.path.join(venv.venvpath, 'bin'))
+            os.symlink(sys.executable, venv.programpath('python'))
+            venv.writeunlock()
+            outpath = os.path.join(tempdir, 'out')
+            with open(os.path.join(tempdir, 'module_name.py'), 'w') as f:
+                f.write("import os, sys\nwith open(%r, 'w') as f: f.write(' '.join(sys.argv[1:] + [os.getcwd(), os.environ['WOO']]))\nsys.exit(3)" % outpath)
+            self.assertIsNone(venv.callzygoteornone([tempdir], 'module_name', ['x']))
+            for accept in True, False:
+                server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                server.bind(venv.zygotepath)
+                server.listen(1)
+                def close():
+                    if accept:
+                        server.accept()[0].close()
+                    else:
+                        time.sleep(.2) # Idle timeout with the connection still queued.
+                    server.close()
+                t = threading.Thread(target = close)
+                t.start()
+                self.assertIsNone(venv.callzygoteornone([tempdir], 'module_name', ['x']))
+                t.join()
+                os.remove(venv.zygotepath)
+            venv.startzygote(1)
+            waitfor(lambda: os.path.exists(venv.zygotepath))
+            self.assertFalse(venv.trywritelock())
+            cwd = os.getcwd()
+            os.environ['WOO'] = 'yay'
+            os.chdir(tempdir)
+            try:
+                os.environ['PYTHONHASHSEED'] = '123' # Fixed at interpreter startup, so not for this zygote.
+                try:
+                    self.assertIsNone(venv.callzygoteornone([tempdir], 'module_name', ['x', 'y']))
+                finally:
+                    del os.environ['PYTHONHASHSEED']
+                self.assertEqual(3, venv.callzygoteornone([tempdir], 'module_name', ['x', 'y']))
+            finally:
+                os.chdir(cwd)
+                del os.environ['WOO']
+            with open(outpath) as f:
+                self.assertEqual("x y %s yay" % tempdir, f.read())
+            waitfor(lambda: not os.path.exists(venv.zygotepath))
+            waitfor(venv.trywritelock)
+
     def test_insertionpoint(self):
         self.assertEqual(0, Execute._insertionpoint(['ax', 'bx', 'cx'], 'x'))
         self.assertEqual(1, Execute._insertionpoint(['a', 'bx', 'cx'], 'x'))
@@ -131,6 +306,33 @@ class TestVenvPool(TestCase):
         self.assertEqual([[0, 1, 2, 3, 4], [5, 6, 7, 8, 9]], list(_chunkify(5, [0, 1, 2, 3, 4, 5, 6, 7, 8, 9])))
         self.assertEqual([[0, 1, 2, 3, 4], [5, 6, 7, 8, 9], [10]], list(_chunkify(5, [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10])))
 
+    def test_sweep(self):
+        from venvpool import _lsofswept, _procswept
+        if not os.path.isdir('/proc/self/fd'):
+            return
+        def trial(swept):
+            with TemporaryDirectory() as tempdir:
+                handles, held = [], []
+                try:
+                    for i in range(2000):
+                        h, p = mkstemp(dir = tempdir)
+                        if i % 1000:
+                            os.close(h)
+                        else:
+                            handles.append(h)
+                            held.append(p)
+                    mark = time.time()
+                    list(swept(os.path.join(tempdir, n) for n in os.listdir(tempdir)))
+                    t = time.time() - mark
+                    return t, sorted(held) == sorted(os.path.join(tempdir, n) for n in os.listdir(tempdir))
+                finally:
+                    for h in handles:
+                        os.close(h)
+        proctime, procok = trial(_procswept)
+        lsoftime, _ = trial(_lsofswept) # Sweeps nothing from a chunk with a held lock.
+        sys.stderr.write("%s < %s ... " % (proctime, lsoftime)) # Not asserted, as lsof speed varies too much between hosts.
+        self.assertTrue(procok)
+
     def test_compress(self):
         c = lambda *paths: list(_compress(paths, '+'))
         self.assertEqual(['-'], c())
@@ -145,12 +347,712 @@ class TestVenvPool(TestCase):
         self.assertEqual(['a+', 'b', 'b'], c('a+b', 'a+b'))
         self.assertEqual(['a+', 'b', 'c'], c('a+b', 'a+c'))
 
+    def test_inventory(self):
+        with TemporaryDirectory() as tempdir:
+            venv = _fakevenv(tempdir, 'Foo_Bar-1.2.dist-info', 'baz-3.0-py3.8.egg-info', 'foo_bar')
+            self.assertEqual({'foo_bar': '1.2', 'baz': '3.0'}, venv.inventory())
+            self.assertTrue(venv.compatible(ParsedRequires(['foo-bar>=1', 'Baz'])))
+            self.assertFalse(venv.compatible(ParsedRequires(['foo-bar>=2'])))
+            self.assertFalse(venv.compatible(ParsedRequires(['woo'])))
+            sitepath = venv.site_packages
+            os.rename(os.path.join(sitepath, 'Foo_Bar-1.2.dist-info'), os.path.join(sitepath, 'Foo_Bar-2.0.dist-info'))
+            os.utime(sitepath, (0, 0)) # Same as any clock granularity.
+            self.assertTrue(venv.compatible(ParsedRequires(['foo-bar>=2'])))
+            self.assertFalse(os.path.exists(venv.inventorypath)) # Only written with the write lock.
+            venv.updateinventory()
+            with open(venv.inventorypath) as f:
+                self.assertEqual(['lib/python3.x/site-packages', '0.0', 'baz 3.0', 'foo_bar 2.0'], f.read().splitlines())
+
+    def test_candidates(self):
+        with _temppool():
+            pool = Pool(3)
+            self.assertEqual([], pool._candidates(ParsedRequires(['foo'])))
+            _fakevenv(os.path.join(pool.versiondir, 'venv1'), 'foo-1.0.dist-info', 'bar-1.0.dist-info')
+            _fakevenv(os.path.join(pool.versiondir, 'venv2'), 'foo-2.0.dist-info')
+            os.mkdir(os.path.join(pool.versiondir, 'venv3')) # Not yet created.
+            c = lambda *requires: [os.path.basename(v.venvpath) for v in pool._candidates(ParsedRequires(requires))]
+            self.assertEqual(['venv1', 'venv2'], c())
+            self.assertEqual(['venv1', 'venv2'], c('foo'))
+            self.assertEqual(['venv2'], c('foo>1'))
+            self.assertEqual(['venv1'], c('foo', 'bar'))
+            self.assertEqual([], c('foo>1', 'bar'))
+            self.assertEqual([], c('baz'))
+            pool._updated(_fakevenv(os.path.join(pool.versiondir, 'venv3'), 'bar-2.0.dist-info'))
+            self.assertEqual(['venv1', 'venv3'], c('bar'))
+
+    def test_singleflight(self):
+        from threading import Thread
+        class SlowPool(Pool):
+            def _newvenv(self, installdeps):
+                builds.append(self._fingerprint(installdeps))
+                time.sleep(.5)
+                venv = _fakevenv(os.path.join(self.versiondir, "venv%s" % len(builds)), 'foo-1.0.dist-info')
+                self._updated(venv)
+                return venv
+        def launch():
+            with pool.readonly(ParsedRequires(['foo'])) as venv:
+                venvs.append(venv.venvpath)
+        builds = []
+        venvs = []
+        with _temppool():
+            pool = SlowPool(3)
+            threads = [Thread(target = launch) for _ in range(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual([pool._fingerprint(ParsedRequires(['foo']))], builds)
+            self.assertEqual([os.path.join(pool.versiondir, 'venv1')] * 4, venvs)
+            self.assertNotEqual(builds[0], pool._fingerprint(ParsedRequires(['foo', 'bar'])))
+
+    def test_creationwait(self):
+        import fcntl
+        from threading import Timer
+        with _temppool() as pooldir:
+            pool = Pool(3)
+            installdeps = ParsedRequires(['foo'])
+            with pool._creationlock(installdeps):
+                pass
+            f = open(os.path.join(pooldir, 'creation', '3', pool._fingerprint(installdeps)), 'a')
+            fcntl.flock(f, fcntl.LOCK_EX) # Like a hung creator.
+            os.environ['VENVPOOL_CREATION_WAIT'] = '.3'
+            try:
+                with _logs(logging.WARNING) as output:
+                    with pool._creationlock(installdeps):
+                        pass
+                self.assertTrue(output)
+                t = Timer(.1, f.close)
+                t.start()
+                with pool._creationlock(installdeps):
+                    self.assertTrue(f.closed)
+                t.join()
+                path = f.name
+                f = open(path, 'a')
+                fcntl.flock(f, fcntl.LOCK_EX)
+                def prune():
+                    os.remove(path)
+                    f.close()
+                t = Timer(.1, prune)
+                t.start()
+                with pool._creationlock(installdeps), open(path) as g:
+                    with self.assertRaises(EnvironmentError):
+                        fcntl.flock(g, fcntl.LOCK_EX | fcntl.LOCK_NB) # Locked the replacement, not the pruned file.
+                t.join()
+            finally:
+                del os.environ['VENVPOOL_CREATION_WAIT']
+                f.close()
+
+    def test_prunebookkeeping(self):
+        import fcntl
+        with _temppool() as pooldir:
+            pool = Pool(3)
+            live, dead = (ParsedRequires([name]) for name in ['foo', 'bar'])
+            os.makedirs(os.path.join(pool.versiondir, 'venv1'))
+            pool._alias(live, Venv(os.path.join(pool.versiondir, 'venv1')))
+            pool._alias(live, Venv(os.path.join(pool.versiondir, 'venv2')))
+            pool._alias(dead, Venv(os.path.join(pool.versiondir, 'venv3')))
+            for installdeps in live, dead:
+                with pool._creationlock(installdeps):
+                    pass
+            creationdir = os.path.join(pooldir, 'creation', '3')
+            with open(os.path.join(creationdir, pool._fingerprint(live))) as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                venvpool._prunebookkeeping()
+            self.assertEqual([pool._fingerprint(live)], os.listdir(creationdir))
+            self.assertEqual([pool._fingerprint(live)], os.listdir(pool.aliasesdir))
+            self.assertEqual(['venv1'], os.listdir(os.path.join(pool.aliasesdir, pool._fingerprint(live))))
+
+    def test_waitforvenv(self):
+        from threading import Timer
+        class NoNewPool(Pool):
+            def _newvenv(self, installdeps):
+                raise Exception
+        with _temppool():
+            pool = NoNewPool(3)
+            venv = _fakevenv(os.path.join(pool.versiondir, 'venv1'), 'foo-1.0.dist-info')
+            pool._updated(venv)
+            os.environ['VENVPOOL_WAIT'] = '.5'
+            try:
+                with self.assertRaises(Exception):
+                    with pool.readonly(ParsedRequires(['foo'])):
+                        pass
+                t = Timer(.2, venv.writeunlock)
+                t.start()
+                try:
+                    with pool.readonly(ParsedRequires(['foo'])) as v:
+                        self.assertEqual(venv.venvpath, v.venvpath)
+                finally:
+                    t.join()
+            finally:
+                del os.environ['VENVPOOL_WAIT']
+
+    def test_upgrade(self):
+        class NoNewPool(Pool):
+            def _newvenv(self, installdeps):
+                raise Exception
+        class FakeRequires(ParsedRequires):
+            def invoke(self, venv):
+                os.mkdir(os.path.join(venv.site_packages, 'qux-1.0.dist-info'))
+        with _temppool():
+            pool = NoNewPool(3)
+            venvs = [
+                _fakevenv(os.path.join(pool.versiondir, 'venv1'), 'foo-1.0.dist-info', 'bar-1.0.dist-info'),
+                _fakevenv(os.path.join(pool.versiondir, 'venv2'), 'foo-2.0.dist-info', 'bar-1.0.dist-info', 'baz-1.0.dist-info'),
+                _fakevenv(os.path.join(pool.versiondir, 'venv3'), 'baz-1.0.dist-info'),
+            ]
+            for venv in venvs:
+                pool._updated(venv)
+                venv.writeunlock()
+            os.environ['VENVPOOL_UPGRADE'] = '1'
+            try:
+                with pool.readonly(FakeRequires(['foo<2', 'bar', 'qux'])) as venv:
+                    self.assertEqual(venvs[0].venvpath, venv.venvpath)
+                    self.assertEqual(dict(foo = '1.0', bar = '1.0', qux = '1.0'), venv.inventory())
+            finally:
+                del os.environ['VENVPOOL_UPGRADE']
+            with self.assertRaises(Exception): # Not enabled.
+                with pool.readonly(FakeRequires(['baz', 'qux'])):
+                    pass
+
+    def test_policy(self):
+        def order(policy):
+            tried = []
+            Pool(3, policy)._lockcompatiblevenv(lambda venv: tried.append(os.path.basename(venv.venvpath)), ParsedRequires(['foo']))
+            return tried
+        with _temppool():
+            pool = Pool(3)
+            venvs = [
+                _fakevenv(os.path.join(pool.versiondir, 'venv1'), 'foo-1.0.dist-info', 'bar-1.0.dist-info', 'baz-1.0.dist-info'),
+                _fakevenv(os.path.join(pool.versiondir, 'venv2'), 'foo-1.0.dist-info'),
+                _fakevenv(os.path.join(pool.versiondir, 'venv3'), 'foo-1.0.dist-info', 'bar-1.0.dist-info'),
+            ]
+            for i, venv in enumerate(venvs):
+                pool._updated(venv)
+                venv.writeunlock()
+                venv.touchlastuse()
+                os.utime(venv.lastusepath, (i, i))
+            locks = [venvs[1].tryreadlock() for _ in range(2)] + [venvs[2].tryreadlock()]
+            try:
+                self.assertEqual(['venv1', 'venv2', 'venv3'], sorted(order('random')))
+                self.assertEqual(['venv3', 'venv2', 'venv1'], order('mru'))
+                self.assertEqual(['venv2', 'venv3', 'venv1'], order('fewest'))
+                self.assertEqual(['venv1', 'venv3', 'venv2'], order('idle'))
+                for venv in venvs:
+                    pool._alias(ParsedRequires(['foo']), venv)
+                for policy, expected in [['mru', 'venv3'], ['fewest', 'venv2'], ['idle', 'venv1']]:
+                    venv, lock = Pool(3, policy)._lockaliasedvenvornone(ParsedRequires(['foo']))
+                    lock.unlock()
+                    self.assertEqual(expected, os.path.basename(venv.venvpath))
+            finally:
+                for lock in locks:
+                    lock.unlock()
+            with self.assertRaises(ValueError):
+                Pool(3, 'woo')
+
+    def test_alias(self):
+        class FakePool(Pool):
+            def _create(self, venv):
+                os.makedirs(os.path.join(venv.venvpath, 'lib', 'python3.x', 'site-packages'))
+        class FakeRequires(ParsedRequires):
+            def invoke(self, venv):
+                os.mkdir(os.path.join(venv.site_packages, 'foo-1.0.dist-info'))
+        def noprobe(*args):
+            raise Exception
+        self.assertEqual(ParsedRequires(['foo>1', 'Bar_baz']).fingerprint('i'), ParsedRequires(['bar-baz', 'foo>1']).fingerprint('i'))
+        self.assertNotEqual(ParsedRequires(['foo']).fingerprint('/usr/bin/python3\n/usr/bin/python3.8\n1:2:3.0'), ParsedRequires(['foo']).fingerprint('/usr/bin/python3\n/usr/bin/python3.8\n1:2:4.0'))
+        with _temppool():
+            pool = FakePool(3)
+            with pool.readonly(FakeRequires(['foo'])) as venv:
+                pass
+            aliaspath, = listorempty(os.path.join(pool.aliasesdir, pool._fingerprint(FakeRequires(['foo']))))
+            self.assertEqual(os.path.realpath(venv.venvpath), os.path.realpath(aliaspath))
+            pool._lockcompatiblevenv = noprobe
+            with pool.readonly(FakeRequires(['foo'])) as v:
+                self.assertEqual(venv.venvpath, v.venvpath)
+            with self.assertRaises(Exception):
+                with pool.readonly(FakeRequires(['foo>=1'])):
+                    pass
+            del pool._lockcompatiblevenv
+            with pool.readonly(FakeRequires(['foo>=1'])) as v:
+                self.assertEqual(venv.venvpath, v.venvpath) # Found by probe, now aliased too.
+            venv.delete()
+            with pool.readonly(FakeRequires(['foo'])) as v:
+                self.assertNotEqual(venv.venvpath, v.venvpath)
+            self.assertEqual([os.path.basename(v.venvpath)], [os.path.basename(p) for p in listorempty(os.path.dirname(aliaspath))])
+
+    def test_srcpaths(self):
+        from venvpool import Activate
+        def write(relpath, text):
+            path = os.path.join(projectdir, relpath)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(text)
+        def isscript(path):
+            scanned.append(os.path.relpath(path, projectdir))
+            return isscriptimpl(path)
+        script = "import sys\n\nif '__main__' == __name__:\n    main()\n"
+        isscriptimpl = venvpool._isscript
+        scanned = []
+        with _temppool() as tempdir:
+            projectdir = os.path.join(tempdir, 'proj')
+            write('a.py', script)
+            write('b.py', 'x = 1\n')
+            write('pkg/__init__.py', '')
+            write('pkg/c.py', script)
+            write('pkg/sub/e.py', script) # Not a package.
+            write('.git/d.py', script)
+            srcpaths = lambda: [os.path.relpath(p, projectdir) for p in Activate._srcpaths(projectdir)]
+            venvpool._isscript = isscript
+            try:
+                self.assertEqual(['a.py', 'pkg/c.py'], srcpaths())
+                self.assertEqual(['a.py', 'b.py', 'pkg/__init__.py', 'pkg/c.py'], sorted(scanned))
+                del scanned[:]
+                self.assertEqual(['a.py', 'pkg/c.py'], srcpaths())
+                self.assertEqual([], scanned)
+                write('b.py', script)
+                os.remove(os.path.join(projectdir, 'a.py'))
+                self.assertEqual(['b.py', 'pkg/c.py'], srcpaths())
+                self.assertEqual(['b.py'], scanned)
+            finally:
+                venvpool._isscript = isscriptimpl
+
+    def test_claimspare(self):
+        with _temppool():
+            pool = Pool(3)
+            os.makedirs(pool.versiondir)
+            self.assertIsNone(pool._claimspareornone())
+            originpath = os.path.join(pool.sparedir, 'partial1')
+            spare = _fakevenv(os.path.join(pool.sparedir, 'spare1'))
+            os.mkdir(os.path.join(spare.venvpath, 'bin'))
+            scriptpath = spare.programpath('pip')
+            with open(scriptpath, 'w') as f:
+                f.write("#!%s/bin/python\n" % originpath)
+            os.chmod(scriptpath, 0o755)
+            os.symlink(sys.executable, spare.programpath('python'))
+            with open(spare.originpath, 'w') as f:
+                f.write(originpath)
+            with open(spare.interpreterpath, 'w') as f:
+                f.write(pool._interpreter())
+            venv = pool._claimspareornone()
+            self.assertEqual([venv.venvpath], listorempty(pool.versiondir))
+            self.assertEqual([], pool._spares())
+            self.assertFalse(os.path.exists(venv.originpath))
+            with open(venv.programpath('pip')) as f:
+                self.assertEqual("#!%s/bin/python\n" % venv.venvpath, f.read())
+            self.assertEqual(0o755, os.stat(venv.programpath('pip')).st_mode & 0o777)
+            self.assertEqual(sys.executable, os.readlink(venv.programpath('python')))
+            self.assertIsNone(pool._claimspareornone())
+
+    def test_fillspares(self):
+        import fcntl
+        class FakePool(Pool):
+            def _create(self, venv):
+                os.makedirs(os.path.join(venv.venvpath, 'lib', 'python3.x', 'site-packages'))
+                with open(venv.interpreterpath, 'w') as f:
+                    f.write(self._interpreter())
+        class FakeRequires(ParsedRequires):
+            def invoke(self, venv):
+                os.mkdir(os.path.join(venv.site_packages, 'foo-1.0.dist-info'))
+        with _temppool():
+            pool = FakePool(3)
+            os.makedirs(pool.sparedir)
+            with open(os.path.join(pool.sparedir, 'fill'), 'a') as f:
+                fcntl.flock(f, fcntl.LOCK_EX) # As if another process is filling.
+                pool.fillspares(2)
+            self.assertEqual([], pool._spares())
+            self.assertEqual(2, pool._sparecount())
+            pool.fillspares()
+            self.assertEqual(2, len(pool._spares()))
+            pool.fillspares()
+            self.assertEqual(2, len(pool._spares()))
+            def detach(*args, **kwargs):
+                raise OSError(errno.ENOENT, 'refill')
+            detachimpl = venvpool._detach
+            venvpool._detach = detach
+            try:
+                with pool.readonly(ParsedRequires([])) as venv: # Refill failure must not fail the launch.
+                    self.assertEqual(pool.versiondir, os.path.dirname(venv.venvpath))
+                spare, = pool._spares()
+                with open(Venv(spare).interpreterpath, 'w') as f:
+                    f.write('/usr/bin/python3\n/usr/bin/python3.0') # As if the interpreter changed since.
+                with pool.readonly(FakeRequires(['foo'])) as venv:
+                    with open(venv.interpreterpath) as f:
+                        self.assertEqual(pool._interpreter(), f.read())
+            finally:
+                venvpool._detach = detachimpl
+            self.assertEqual([], pool._spares())
+            self.assertEqual(2, len(os.listdir(pool.versiondir)))
+
+    def test_clone(self):
+        with TemporaryDirectory() as tempdir:
+            template = _fakevenv(os.path.join(tempdir, 'template'), 'foo-1.0.dist-info')
+            os.symlink('lib', os.path.join(template.venvpath, 'lib64'))
+            os.mkdir(os.path.join(template.venvpath, 'bin'))
+            os.symlink(sys.executable, template.programpath('python'))
+            with open(template.programpath('pip'), 'w') as f:
+                f.write("#!%s/bin/python\n" % template.venvpath)
+            os.chmod(template.programpath('pip'), 0o755)
+            modulepath = os.path.join(template.site_packages, 'foo.py')
+            with open(modulepath, 'w') as f:
+                f.write('woo = 100\n')
+            venvpath = os.path.join(tempdir, 'venv')
+            os.mkdir(venvpath)
+            template.clone(venvpath)
+            venv = Venv(venvpath)
+            self.assertEqual('lib', os.readlink(os.path.join(venvpath, 'lib64')))
+            self.assertEqual(sys.executable, os.readlink(venv.programpath('python')))
+            with open(venv.programpath('pip')) as f:
+                self.assertEqual("#!%s/bin/python\n" % venvpath, f.read())
+            with open(os.path.join(venv.site_packages, 'foo.py')) as f:
+                self.assertEqual('woo = 100\n', f.read())
+            self.assertEqual({'foo': '1.0'}, venv.inventory())
+            self.assertFalse(os.path.exists(venv.originpath))
+            self.assertFalse(os.path.exists(template.originpath))
+
+    def test_template(self):
+        def create(venv, pyversion):
+            os.mkdir(os.path.join(venv.venvpath, 'bin'))
+            os.symlink(Venv._safewhich("python%s" % pyversion), venv.programpath('python'))
+        def shim(name):
+            bindir = os.path.join(tempdir, name)
+            os.mkdir(bindir)
+            os.symlink(sys.executable, os.path.join(bindir, 'python3'))
+            os.environ['PATH'] = bindir
+        with _temppool(), TemporaryDirectory() as tempdir:
+            path = os.environ['PATH']
+            realcreate = Venv.create
+            Venv.create = create
+            try:
+                pool = Pool(3)
+                shim('a')
+                template = pool._template()
+                self.assertEqual(template.venvpath, pool._template().venvpath)
+                shim('b') # Same realpath, different interpreter.
+                other = pool._template()
+                self.assertNotEqual(template.venvpath, other.venvpath)
+                self.assertFalse(os.path.exists(template.venvpath))
+                os.remove(other.interpreterpath)
+                self.assertNotEqual(other.venvpath, pool._template().venvpath)
+                shim('c')
+                def slowcreate(venv, pyversion):
+                    time.sleep(.2)
+                    create(venv, pyversion)
+                Venv.create = slowcreate
+                templates = []
+                threads = [threading.Thread(target = lambda: templates.append(pool._template().venvpath)) for _ in range(2)]
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+                self.assertEqual(1, len(set(templates)))
+                templatesdir = os.path.dirname(pool.templatepath)
+                self.assertEqual(sorted([os.path.basename(templates[0]), '3']), sorted(os.listdir(templatesdir)))
+                template = Venv(templates[0])
+                for path in template.inventorypath, template.lastusepath, template.zygotepath:
+                    with open(path, 'w'):
+                        pass
+                os.mkdir(os.path.join(template.venvpath, 'readlocks'))
+                clonepath = os.path.join(tempdir, 'clone')
+                os.mkdir(clonepath)
+                template.clone(clonepath)
+                self.assertEqual(['bin'], os.listdir(clonepath))
+            finally:
+                Venv.create = realcreate
+                os.environ['PATH'] = path
+
+    def test_unshare(self):
+        with TemporaryDirectory() as tempdir:
+            venv = _fakevenv(os.path.join(tempdir, 'venv'), 'foo-1.0.dist-info', 'foo', 'bar-1.0.dist-info')
+            os.mkdir(os.path.join(venv.venvpath, 'bin'))
+            sitepath = venv.site_packages
+            relpaths = ['foo/__init__.py', '../../../bin/foo', 'foo-1.0.dist-info/RECORD', 'bar-1.0.dist-info/RECORD']
+            texts = ['', '', ''.join("%s,,\n" % r for r in relpaths[:3]), 'bar-1.0.dist-info/RECORD,,\n']
+            for relpath, text in zip(relpaths, texts):
+                with open(os.path.join(sitepath, relpath), 'w') as f:
+                    f.write(text)
+            os.mkdir(os.path.join(tempdir, 'other'))
+            for i, relpath in enumerate(relpaths):
+                os.link(os.path.join(sitepath, relpath), os.path.join(tempdir, 'other', str(i)))
+            nlinks = lambda: [os.stat(os.path.join(sitepath, r)).st_nlink for r in relpaths]
+            venv.unshare(['Foo', 'baz'])
+            self.assertEqual([1, 1, 1, 2], nlinks())
+            with open(os.path.join(sitepath, 'bar-1.0.dist-info', 'RECORD')) as f:
+                self.assertEqual('bar-1.0.dist-info/RECORD,,\n', f.read())
+            venv.unshare()
+            self.assertEqual([1, 1, 1, 1], nlinks())
+            with open(os.path.join(sitepath, 'bar-1.0.dist-info', 'RECORD')) as f:
+                self.assertEqual('bar-1.0.dist-info/RECORD,,\n', f.read())
+
+    def test_redundantvenvs(self):
+        venvs = {n: Venv(os.path.join(d, n)) for d, names in [('3', 'abcdef'), ('2', 'g')] for n in names}
+        freezes = dict(
+            a = {'foo==1', 'bar==1'},
+            b = {'foo==1'},
+            c = {'foo==2'},
+            d = {'foo==2'},
+            e = set(),
+            f = {'bar==1', 'baz==1'},
+            g = {'foo==1'},
+        )
+        redundant = Compact._redundantvenvs({venvs[n]: freeze for n, freeze in freezes.items()})
+        self.assertEqual(['b', 'd', 'e'], sorted(os.path.basename(v.venvpath) for v in redundant))
+        self.assertEqual([], Compact._redundantvenvs({venvs['e']: set()}))
+
+    def test_mergegroups(self):
+        venvs = {n: Venv(os.path.join(d, n)) for d, names in [('3', 'abcd'), ('2', 'ef')] for n in names}
+        freezes = dict(
+            a = {'foo==1', 'bar==1'},
+            b = {'foo==2'},
+            c = {'bar==1', 'baz==1'},
+            d = {'qux==1'},
+            e = {'foo==1'},
+            f = {'foo==2'},
+        )
+        groups = [(sorted(os.path.basename(v.venvpath) for v in venvs), pins) for venvs, pins in Compact._mergegroups({venvs[n]: freeze for n, freeze in freezes.items()})]
+        self.assertEqual([(['a', 'c', 'd'], dict(foo = '1', bar = '1', baz = '1', qux = '1'))], groups)
+
+    def test_freeze(self):
+        with TemporaryDirectory() as tempdir:
+            venv = _fakevenv(tempdir, 'Foo_Bar-1.0.dist-info', 'pip-23.0.dist-info', 'baz-2.0-py3.9.egg-info')
+            self.assertEqual({'foo_bar==1.0', 'baz==2.0'}, Compact._freeze(venv))
+
+    def test_evictees(self):
+        with TemporaryDirectory() as tempdir:
+            venvs = [Venv(os.path.join(tempdir, "venv%s" % i)) for i in range(3)]
+            for i, (venv, name) in enumerate(zip(venvs, 'abc')):
+                os.mkdir(venv.venvpath)
+                with open(os.path.join(venv.venvpath, name), 'w') as f:
+                    f.write('x' * 10000)
+            os.link(os.path.join(venvs[0].venvpath, 'a'), os.path.join(venvs[1].venvpath, 'a'))
+            for i, venv in enumerate(venvs):
+                venv.touchlastuse()
+                os.utime(venv.lastusepath, (i, i))
+            for venv in reversed(venvs): # Locking must not count as use.
+                venv.writeunlock()
+                self.assertTrue(venv.trywritelock())
+            lastuse = {venv: venv.lastuse() for venv in venvs}
+            self.assertEqual([0, 1, 2], [lastuse[v] for v in venvs])
+            size = os.stat(os.path.join(venvs[0].venvpath, 'a')).st_blocks * 512
+            evictees = lambda locked, maxbytes, maxcount: [venvs.index(v) for v in Evict._evictees(venvs, locked, maxbytes, maxcount, lastuse)]
+            self.assertEqual([], evictees(venvs, None, None))
+            self.assertEqual([], evictees(venvs, size * 3, 3))
+            self.assertEqual([0], evictees(venvs, None, 2))
+            self.assertEqual([0, 1], evictees(venvs, None, 1))
+            self.assertEqual([1], evictees(venvs, size * 3 - 1, None)) # Evicting the oldest would free nothing.
+            self.assertEqual([1, 2, 0], evictees(venvs, 0, None))
+            self.assertEqual([2], evictees([venvs[0], venvs[2]], size * 3 - 1, None)) # Busy venv is kept.
+
+    def test_dedup(self):
+        def write(relpath, text):
+            path = os.path.join(tempdir, relpath)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(text)
+        ino = lambda relpath: os.stat(os.path.join(tempdir, relpath)).st_ino
+        with _temppool() as tempdir:
+            for i in range(150): # Enough for the process pool.
+                write("venv1/lib/%s" % i, str(i))
+            write('venv1/a', 'x')
+            write('venv1/b', 'x')
+            write('venv1/c', 'y')
+            write('venv1/lock', '')
+            write('venv2/a', 'x')
+            write('venv2/c', 'z')
+            write('venv2/lock', '')
+            os.symlink('a', os.path.join(tempdir, 'venv2', 'd'))
+            Compact._compactvenvs([os.path.join(tempdir, n) for n in ['venv1', 'venv2']])
+            self.assertEqual(1, len(set(ino(p) for p in ['venv1/a', 'venv1/b', 'venv2/a'])))
+            self.assertEqual(5, len(set(ino(p) for p in ['venv1/a', 'venv1/c', 'venv2/c', 'venv1/lock', 'venv2/lock'])))
+            self.assertTrue(os.path.islink(os.path.join(tempdir, 'venv2', 'd')))
+            write('venv3/a', 'x')
+            write('venv3/lib/0', '0')
+            with _logs(logging.DEBUG) as output:
+                Compact._compactvenvs([os.path.join(tempdir, n) for n in ['venv1', 'venv2', 'venv3']])
+            self.assertIn('DEBUG:venvpool:Hash 2 of 157 files.', output)
+            self.assertIn('DEBUG:venvpool:Replaced 2 files with hardlinks.', output)
+            self.assertEqual(ino('venv1/a'), ino('venv3/a'))
+            self.assertEqual(ino('venv1/lib/0'), ino('venv3/lib/0'))
+
+    def test_wheelhouseinstall(self):
+        def calls():
+            with open(logpath) as f:
+                return [l.split()[0] for l in f]
+        with TemporaryDirectory() as tempdir:
+            logpath = os.path.join(tempdir, 'log')
+            wheelhouse = os.path.join(tempdir, 'wheelhouse')
+            venv = _fakevenv(os.path.join(tempdir, 'venv'))
+            os.mkdir(os.path.join(venv.venvpath, 'bin'))
+            with open(venv.programpath('pip'), 'w') as f:
+                f.write('\n'.join([
+                    "#!%s" % sys.executable,
+                    'import os, sys',
+                    "with open(%r, 'a') as f: f.write(' '.join(sys.argv[1:]) + '\\n')" % logpath,
+                    'args = sys.argv[2:]',
+                    "if 'wheel' == sys.argv[1]:",
+                    "    for name in args[4:]: 'broken' == name or open(os.path.join(args[1], name + '.whl'), 'w').close()",
+                    "missing = [n for n in args[3:] if not os.path.exists(os.path.join(args[2], n + '.whl'))]",
+                    "if 'install' == sys.argv[1] and missing: sys.exit('No matching distribution: %s' % ' '.join(missing))",
+                ]))
+            os.chmod(venv.programpath('pip'), 0o755)
+            os.mkdir(wheelhouse)
+            open(os.path.join(wheelhouse, 'foo.whl'), 'w').close()
+            venv.install(['foo'], wheelhouse)
+            self.assertEqual(['install'], calls())
+            with _logs(logging.DEBUG) as output:
+                venv.install(['foo', 'bar'], wheelhouse)
+            self.assertEqual(['install', 'install', 'wheel', 'install'], calls())
+            self.assertIn('No matching distribution: bar', '\n'.join(output))
+            self.assertEqual(['bar.whl', 'foo.whl'], sorted(os.listdir(wheelhouse)))
+            self.assertEqual(['log', 'venv', 'wheelhouse'], sorted(os.listdir(tempdir))) # Temporary wheel dir removed.
+            with self.assertRaises(subprocess.CalledProcessError):
+                venv.install(['broken'], wheelhouse)
+            self.assertEqual(['install', 'install', 'wheel', 'install', 'install', 'wheel', 'install'], calls())
+
+    def test_pinned(self):
+        class RecordingVenv:
+            def install(self, args, wheelhouse = None):
+                calls.append(wheelhouse is not None)
+        calls = []
+        with _temppool():
+            for reqs in ['foo==1.0'], ['foo===1.0', 'bar==2.*'], ['foo==1.0', 'bar>=2'], ['foo'], ['foo>=1,<=1']:
+                ParsedRequires(reqs).invoke(RecordingVenv())
+        self.assertEqual([True, False, False, False, False], calls)
+        self.assertTrue(FastReq.parselines(['foo>=1,==1.0'])[0].pinned)
+
+    def test_linkinstall(self):
+        from zipfile import ZipFile, ZipInfo
+        def wheel(name, version, requires, files, tag = 'py3-none-any'):
+            path = os.path.join(wheelhouse, "%s-%s-%s.whl" % (name, version, tag))
+            distinfo = "%s-%s.dist-info" % (name, version)
+            with ZipFile(path, 'w') as z:
+                for filename, text in dict(files, **{
+                    distinfo + '/METADATA': ''.join("Requires-Dist: %s\n" % r for r in requires) + '\nRequires-Dist: ignored\n',
+                    distinfo + '/RECORD': 'stale',
+                }).items():
+                    z.writestr(filename, text)
+        with TemporaryDirectory() as tempdir:
+            wheelhouse = os.path.join(tempdir, 'wheelhouse')
+            os.mkdir(wheelhouse)
+            wheel('foo', '1.0', ['bar (>=2)', 'baz; extra == "woo"'], {'foo.py': 'foo = 1\n', 'foo-1.0.dist-info/entry_points.txt': '[console_scripts]\nfoo = foo:main.run\n'})
+            wheel('bar', '1.0', [], {'bar.py': 'bar = 1\n'})
+            wheel('bar', '2.0', [], {'bar.py': 'bar = 2\n', 'bar-2.0.data/scripts/barscript': '#!python\nbar\n', 'bar-2.0.dist-info/INSTALLER': 'pip\n'})
+            wheel('bar', '3.0', [], {}, 'cp311-cp311-linux_x86_64')
+            wheel('bad', '1.0', ['bar; python_version < "3"'], {})
+            wheel('nocallable', '1.0', [], {'nocallable-1.0.dist-info/entry_points.txt': '[console_scripts]\nnocallable = nocallable\n'})
+            venv = _fakevenv(os.path.join(tempdir, 'venv'), 'setuptools-50.0.dist-info')
+            os.mkdir(os.path.join(venv.venvpath, 'bin'))
+            r = lambda *reqstrs: [os.path.basename(p) for p in WheelStore.resolveornone(wheelhouse, reqstrs, venv.inventory(), {'py3', 'py311'}) or ()]
+            self.assertEqual(['foo-1.0-py3-none-any.whl', 'bar-2.0-py3-none-any.whl'], r('foo'))
+            self.assertEqual(['bar-1.0-py3-none-any.whl'], r('bar<2'))
+            self.assertEqual([], r('foo', 'bar<2'))
+            self.assertEqual([], r('bad'))
+            self.assertEqual([], r('nocallable'))
+            self.assertEqual([], r('setuptools>50'))
+            self.assertEqual(['bar-2.0-py3-none-any.whl'], r('setuptools', 'bar'))
+            store = WheelStore(os.path.join(tempdir, 'store'))
+            store.install(venv, WheelStore.resolveornone(wheelhouse, ['foo'], venv.inventory(), {'py3'}))
+            self.assertEqual({'bar': '2.0', 'foo': '1.0', 'setuptools': '50.0'}, venv.inventory())
+            modulepath = os.path.join(venv.site_packages, 'foo.py')
+            self.assertEqual(2, os.stat(modulepath).st_nlink)
+            with open(os.path.join(venv.site_packages, 'foo-1.0.dist-info', 'RECORD')) as f:
+                records = [l.split(',') for l in f.read().splitlines()]
+            self.assertEqual(sorted([
+                'foo.py',
+                'foo-1.0.dist-info/entry_points.txt',
+                'foo-1.0.dist-info/METADATA',
+                '../../../bin/foo',
+                'foo-1.0.dist-info/INSTALLER',
+            ]), sorted(r[0] for r in records[:-1])) # Zip order.
+            self.assertEqual(['sha256=' + urlsafe_b64encode(sha256(b'foo = 1\n').digest()).rstrip(b'=').decode('ascii'), '8'], dict((r[0], r[1:]) for r in records)['foo.py'])
+            self.assertEqual(['foo-1.0.dist-info/RECORD', '', ''], records[-1])
+            with open(venv.programpath('foo')) as f:
+                self.assertEqual("#!%s\nimport sys\nfrom foo import main\nif '__main__' == __name__:\n    sys.exit(main.run())\n" % os.path.abspath(venv.programpath('python')), f.read())
+            with open(venv.programpath('barscript')) as f:
+                self.assertEqual("#!%s\nbar\n" % os.path.abspath(venv.programpath('python')), f.read())
+            installerpath = os.path.join(venv.site_packages, 'bar-2.0.dist-info', 'INSTALLER')
+            self.assertEqual(1, os.stat(installerpath).st_nlink)
+            with open(installerpath) as f:
+                self.assertEqual('venvpool\n', f.read())
+            with open(os.path.join(venv.site_packages, 'bar-2.0.dist-info', 'RECORD')) as f:
+                self.assertEqual(1, sum(1 for l in f if l.startswith('bar-2.0.dist-info/INSTALLER,')))
+            otherpath = os.path.join(tempdir, 'other')
+            other = _fakevenv(otherpath)
+            os.mkdir(os.path.join(otherpath, 'bin'))
+            store.install(other, WheelStore.resolveornone(wheelhouse, ['foo'], other.inventory(), {'py3'}))
+            self.assertEqual(os.stat(modulepath).st_ino, os.stat(os.path.join(other.site_packages, 'foo.py')).st_ino)
+
+    def test_resolution(self):
+        def write(path, text):
+            with open(path, 'w') as f:
+                f.write(text)
+        with _temppool() as tempdir:
+            projectdir = os.path.join(tempdir, 'workspace', 'proj')
+            otherdir = os.path.join(tempdir, 'workspace', 'other')
+            os.makedirs(os.path.join(projectdir, 'pkg'))
+            os.mkdir(otherdir)
+            write(os.path.join(projectdir, 'requirements.txt'), 'other\nfoo>=1\n')
+            write(os.path.join(otherdir, 'requirements.txt'), 'bar\n')
+            scriptpath = os.path.join(projectdir, 'pkg', 'script.py')
+            expected = [projectdir, otherdir], 'pkg.script', ['foo>=1', 'bar']
+            resolution = Resolution(scriptpath)
+            self.assertIsNone(resolution.loadornone())
+            self.assertEqual(expected, Launch._resolve(resolution))
+            self.assertEqual(expected, resolution.loadornone())
+            self.assertIsNone(Resolution(os.path.join(projectdir, 'script.py')).loadornone())
+            write(os.path.join(otherdir, 'requirements.txt'), 'bar\nbaz\n')
+            self.assertIsNone(resolution.loadornone())
+            self.assertEqual(([projectdir, otherdir], 'pkg.script', ['foo>=1', 'bar', 'baz']), Launch._resolve(resolution))
+            write(os.path.join(projectdir, 'pkg', 'requirements.txt'), '')
+            self.assertIsNone(resolution.loadornone())
+            Launch._resolve(resolution)
+            self.assertIsNotNone(resolution.loadornone())
+            with open(resolution.path) as f:
+                text = f.read()
+            write(resolution.path, text.replace("i\t%s\t" % sys.executable, "i\t%s2\t" % sys.executable))
+            self.assertIsNone(resolution.loadornone())
+
     def test_decompress(self):
         d = lambda *paths: list(_decompress(paths))
         self.assertEqual([], d('a'))
         self.assertEqual(['ab'], d('a', 'b'))
         self.assertEqual(['ab', 'ac'], d('a', 'b', 'c'))
 
+@contextmanager
+def _temppool():
+    with TemporaryDirectory() as tempdir:
+        pooldir = venvpool.pooldir
+        venvpool.pooldir = tempdir
+        try:
+            yield tempdir
+        finally:
+            venvpool.pooldir = pooldir
+
+@contextmanager
+def _logs(level): # Like assertLogs, which Python 2 lacks.
+    class Handler(logging.Handler):
+        def emit(self, record):
+            output.append("%s:%s:%s" % (record.levelname, record.name, record.getMessage()))
+    output = []
+    logger = logging.getLogger(venvpoolname)
+    handler = Handler()
+    oldlevel = logger.level
+    logger.addHandler(handler)
+    logger.setLevel(level)
+    try:
+        yield output
+    finally:
+        logger.removeHandler(handler)
+        logger.setLevel(oldlevel)
+
+def _fakevenv(venvpath, *names):
+    sitepath = os.path.join(venvpath, 'lib', 'python3.x', 'site-packages')
+    os.makedirs(sitepath)
+    for name in names:
+        os.mkdir(os.path.join(sitepath, name))
+    return Venv(venvpath)
+
 class BaseReq:
 
     @classmethod
@@ -175,6 +1077,36 @@ class BaseReq:
     def acceptversion(self, versionstr):
         return versionstr in self.parsed
 
+class LegacyReq: # As FastReq was before version keys, for benchmarking.
+
+    class Version:
+
+        def __init__(self, operator, splitversion):
+            self.operator = operator
+            self.splitversion = splitversion
+
+        def accept(self, splitversion):
+            def pad(v):
+                return v + [0] * (n - len(v))
+            versions = [splitversion, self.splitversion]
+            n = max(map(len, versions))
+            return self.operator(*map(pad, versions))
+
+    @staticmethod
+    def _splitversion(versionstr):
+        return [int(k) for k in versionstr.split('.')]
+
+    @classmethod
+    def parselines(cls, lines):
+        return [cls(r) for r in FastReq.parselines(lines)]
+
+    def __init__(self, fastreq):
+        self.versions = [self.Version(FastReq.operators[o], self._splitversion(v)) for o, v in re.findall('([<>=!]+)([^,]+)', fastreq.reqstr)]
+
+    def acceptversion(self, versionstr):
+        splitversion = self._splitversion(versionstr)
+        return all(v.accept(splitversion) for v in self.versions)
+
 class ReqCase:
 
     def test_parse(self):
@@ -224,10 +1156,92 @@ class ReqCase:
             self.assertEqual((), r.extras)
             self.assertEqual('foo', r.reqstr)
 
+    def test_ordering(self):
+        r, = self.reqcls.parselines(['foo>=1.0.dev1,<2'])
+        self.assertFalse(r.acceptversion('0.9'))
+        self.assertFalse(r.acceptversion('1.0.dev0'))
+        self.assertTrue(r.acceptversion('1.0.dev1'))
+        self.assertTrue(r.acceptversion('1.0a1'))
+        self.assertTrue(r.acceptversion('1.0rc1.dev3'))
+        self.assertTrue(r.acceptversion('1.0'))
+        self.assertTrue(r.acceptversion('1.0.post1'))
+        self.assertTrue(r.acceptversion('1.5+local.7'))
+        self.assertFalse(r.acceptversion('2.0'))
+        self.assertFalse(r.acceptversion('1!1.0'))
+
 class TestFastReq(TestCase, ReqCase):
 
     reqcls = FastReq
 
+    def test_versionkey(self):
+        versions = ['1.0.dev456', '1.0a1', '1.0a2.dev456', '1.0a12.dev456', '1.0a12', '1.0b1.dev456', '1.0b2', '1.0b2.post345.dev456', '1.0b2.post345', '1.0rc1.dev456', '1.0rc1', '1.0', '1.0+abc.5', '1.0+abc.7', '1.0+5', '1.0.post456.dev34', '1.0.post456', '1.0.15', '1.1.dev1', '1!0.5']
+        self.assertEqual(versions, sorted(reversed(versions), key = _versionkey))
+        for v, w in ('1', '1.0.0'), ('1.0a', 'v1.0-ALPHA0'), ('1.0c1', '1.0rc1'), ('1.0-1', '1.0.post1'), ('1.0dev', '1.0.dev0'), ('1.0+a-b', '1.0+A.b'):
+            self.assertEqual(_versionkey(v), _versionkey(w))
+        self.assertIsNone(_versionkey('woo'))
+        hash(FastReq.parselines(['foo>1,<2'])[0].versions)
+
+    def test_differential(self):
+        lines = [
+            'foo~=2.2', 'foo~=2.2.0', 'foo~=1.4.5a4', 'foo~=1!2.2',
+            'foo==1.*', 'foo==1.0.*', 'foo!=1.5.*', 'foo==2!1.*',
+            'foo==1.0', 'foo==1.0+abc', 'foo!=1.0', 'foo===1.0b1',
+            'foo<1.0', 'foo<1.0rc1', 'foo<=1.0', 'foo>=1.0', 'foo>1.0', 'foo>1.0.post1', 'foo>1.0.dev0',
+            'foo (>=1.0rc1, !=1.5.*)', 'foo>=0.9,<2.0a1,!=1.0.post1',
+        ]
+        versions = [
+            '0.9', '1', '1.0', '1.0.0', '1.0+abc', '1.0+5', '1.0.dev0', '1.0a1', '1.0b1', '1.0rc1', '1.0rc1.dev2', '1.0.post1', '1.0.post1.dev1', '1.0.post2',
+            '1.4.5', '1.4.5a4', '1.4.9', '1.5', '1.5.0', '1.5.1', '1.9', '2', '2.0a1', '2.1', '2.2', '2.2.0', '2.2.1', '2.3', '3.0', '1!0.5', '1!2.2', '1!2.9', '2!1.5',
+        ]
+        for line in lines:
+            fast, = FastReq.parselines([line])
+            base, = BaseReq.parselines([line])
+            for v in versions:
+                if sys.version_info.major < 3 and (line, v) in {('foo~=1.4.5a4', '1.4.9'), ('foo<=1.0', '1.0+abc'), ('foo<=1.0', '1.0+5')}:
+                    continue # The reference available to Python 2 predates the fixes.
+                self.assertEqual(base.acceptversion(v), fast.acceptversion(v), (line, v))
+        markers = [
+            'python_version >= "3"', 'python_version < "3"', "python_version > '2.7' and python_version < '4'",
+            'python_full_version >= "3.6.0"', 'os_name == "posix" or os_name == "nt"', '"linux" in sys_platform', '"linux" not in sys_platform',
+            'sys_platform == "win32"', 'platform_system != "Windows"', 'platform_machine == "x86_64" or platform_machine == "aarch64"',
+            'implementation_name == "cpython"', 'platform_python_implementation == "PyPy"', 'implementation_version >= "3"',
+            'python_version ~= "3.0"', '(python_version < "3" or os_name == "posix") and extra == ""', 'extra == "test"',
+            'os.name == "posix"', 'sys.platform != "win32"', 'python_implementation == "CPython"', 'platform.python_implementation == "PyPy"',
+            'implementation_name == ""',
+        ]
+        for marker in markers:
+            line = "foo>=1 ; %s" % marker
+            base, = parse_requirements(line)
+            self.assertEqual(base.marker.evaluate(dict(extra = '')), bool(FastReq.parselines([line])), marker)
+        with self.assertRaises(ValueError):
+            FastReq.parselines(['foo>=1 ; no_such_name == "x"'])
+
+    def test_versionkeycache(self):
+        n = len(venvpool._versionkeys)
+        _versionkey('1.2.3')
+        self.assertLessEqual(len(venvpool._versionkeys), n + 1)
+        for i in range(10100):
+            _versionkey("0.%s" % i)
+        self.assertEqual(10000, len(venvpool._versionkeys))
+        self.assertEqual('0.10099', next(reversed(venvpool._versionkeys)))
+
+    def test_benchmark(self):
+        def accepttime(reqcls):
+            reqs = reqcls.parselines(reqstrs)
+            mark = time.time()
+            for _ in range(200):
+                for v in versions:
+                    for r in reqs:
+                        r.acceptversion(v)
+            return time.time() - mark
+        reqstrs = ['foo>=1.2,<3', 'bar==2.0.1', 'baz!=1.5']
+        versions = ["%s.%s.%s" % (i % 4, i % 7, i % 3) for i in range(50)]
+        fast, legacy, base = (min(accepttime(c) for _ in range(3)) for c in [FastReq, LegacyReq, BaseReq])
+        sys.stderr.write("%s < %s < %s ... " % (fast, legacy, base)) # Timings only, the unit suite does not gate on them.
+        accepted = [[[r.acceptversion(v) for r in c.parselines(reqstrs)] for v in versions] for c in [FastReq, LegacyReq, BaseReq]]
+        self.assertEqual(accepted[0], accepted[1])
+        self.assertEqual(accepted[0], accepted[2])
+
 class TestBaseReq(TestCase, ReqCase):
 
     reqcls = BaseReq
@@ -98,12 +98,111 @@ class Execute:
             i -= 1
         return i
 
+@_shortcut
+class Zygote:
+
+    help = 'serve launches from a warm interpreter for internal use only'
+    letter = 'Z'
+
+    @classmethod
+    def main(cls):
+        import signal, socket
+        assert '-Z' == sys.argv.pop(1)
+        sockpath = sys.argv.pop(1)
+        lockhandle = int(sys.argv.pop(1))
+        idle = float(sys.argv.pop(1))
+        def terminate(*args):
+            sys.exit(128 + signal.SIGTERM)
+        signal.signal(signal.SIGTERM, terminate)
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN) # Reap automatically.
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        temppath = "%s.%s" % (sockpath, os.getpid())
+        server.bind(temppath)
+        server.listen(64)
+        inode = os.stat(temppath).st_ino
+        os.rename(temppath, sockpath)
+        try:
+            server.settimeout(idle)
+            while True:
+                try:
+                    conn = server.accept()[0]
+                except socket.timeout:
+                    break
+                if not os.fork():
+                    try: # Must not unwind into the server.
+                        server.close()
+                        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                        os._exit(cls._serve(conn))
+                    finally:
+                        os._exit(1)
+                conn.close()
+        finally:
+            if os.stat(sockpath).st_ino == inode: # Otherwise replaced by another zygote.
+                os.remove(sockpath)
+            os.close(lockhandle)
+
+    @staticmethod
+    def _serve(conn):
+        from array import array
+        import atexit, signal, socket
+        conn.settimeout(None)
+        handles = array('i')
+        data, ancdata = conn.recvmsg(0x10000, socket.CMSG_SPACE(3 * handles.itemsize))[:2]
+        for level, kind, cmsgdata in ancdata:
+            if socket.SOL_SOCKET == level and socket.SCM_RIGHTS == kind:
+                handles.frombytes(cmsgdata[:len(cmsgdata) - len(cmsgdata) % handles.itemsize])
+        chunks = [data]
+        while chunks[-1]:
+            chunks.append(conn.recv(0x10000))
+        fields = [os.fsdecode(f) for f in b''.join(chunks).split(b'\0')]
+        cwd, localreqs, module, argc = fields[:4]
+        argc = int(argc)
+        scriptargs = fields[4:4 + argc]
+        for target, h in enumerate(handles):
+            os.dup2(h, target)
+            os.close(h)
+        for target, name in enumerate(['stdin', 'stdout', 'stderr']):
+            setattr(sys, name, os.fdopen(os.dup(target), 'r' if 0 == target else 'w', 1 if 2 == target or os.isatty(target) else -1))
+        os.chdir(cwd)
+        os.environ.clear()
+        os.environ.update(f.split('=', 1) for f in fields[4 + argc:])
+        conn.sendall(("%s\n" % os.getpid()).encode())
+        sys.argv[1:] = ['-X', localreqs, module] + scriptargs
+        try:
+            Execute.main()
+            status = 0
+        except SystemExit as e:
+            status = e.code
+            if status is None:
+                status = 0
+            elif not isinstance(status, int):
+                sys.stderr.write("%s\n" % status)
+                status = 1
+        except KeyboardInterrupt:
+            status = 128 + signal.SIGINT
+        except:
+            sys.excepthook(*sys.exc_info())
+            status = 1
+        atexit._run_exitfuncs() # XXX: Also join non-daemon threads?
+        for f in sys.stdout, sys.stderr:
+            f.flush()
+        conn.sendall(("%s\n" % status).encode())
+        return status
+
 from collections import OrderedDict
 from contextlib import contextmanager
 from random import shuffle # XXX: Expensive?
-from stat import S_IXUSR, S_IXGRP, S_IXOTH
+from stat import S_ISREG, S_IXUSR, S_IXGRP, S_IXOTH
 from tempfile import mkdtemp, mkstemp
 import errno, logging, operator, re, shutil # XXX: Still expensive?
+try:
+    from _sha256 import sha256 # Much cheaper to load than hashlib, which initialises OpenSSL.
+except ImportError:
+    try:
+        from _sha2 import sha256
+    except ImportError:
+        from hashlib import sha256
 
 class subprocess:
 
@@ -113,7 +212,11 @@ class subprocess:
 
 log = logging.getLogger(__name__)
 chainrelpath = os.path.join('venvpool', 'chain.py')
+trampolinerelpath = os.path.join('venvpool', 'execute.py')
+sourcehelp = 'write scripts that compile the venvpool source every run instead of importing it from its bytecode cache'
 dotpy = '.py'
+versionkeyregex = r"^\s*v?(?:([0-9]+)!)?([0-9]+(?:[.][0-9]+)*)(?:[-_.]?(a|b|c|rc|alpha|beta|pre|preview)[-_.]?([0-9]+)?)?(?:-([0-9]+)|[-_.]?(post|rev|r)[-_.]?([0-9]+)?)?(?:[-_.]?(dev)[-_.]?([0-9]+)?)?(?:[+]([a-z0-9]+(?:[-_.][a-z0-9]+)*))?\s*$" # PEP 440.
+inventoryregexes = "^([^-]+)-(.+)[.]dist-info$", "^([^-]+)-([^-]+).*[.]egg-info$"
 executablebits = S_IXUSR | S_IXGRP | S_IXOTH
 oserrors = {code: type(name, (OSError,), {}) for code, name in errno.errorcode.items()}
 pooldir = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), 'venvpool')
@@ -127,11 +230,12 @@ except AttributeError:
         fcntl(h, F_SETFD, fcntl(h, F_GETFD) & ~FD_CLOEXEC)
 subprocess = subprocess()
 userbin = os.path.join(os.path.expanduser('~'), '.local', 'bin')
+_lockbackends = {}
 
 def _osop(f, *args, **kwargs):
     try:
         return f(*args, **kwargs)
-    except OSError as e:
+    except EnvironmentError as e: # Includes IOError from fcntl on Python 2.
         raise oserrors[e.errno](*e.args)
 
 @contextmanager
@@ -150,6 +254,49 @@ def _onerror(f):
         f()
         raise
 
+def _isopenedpath(f, path):
+    try:
+        st = _osop(os.stat, path)
+    except oserrors[errno.ENOENT]:
+        return False
+    fst = os.fstat(f.fileno())
+    return (st.st_dev, st.st_ino) == (fst.st_dev, fst.st_ino)
+
+@contextmanager
+def _boundedflock(path, label):
+    try:
+        import fcntl
+    except ImportError:
+        yield
+        return
+    import time
+    _makedirs(os.path.dirname(path))
+    timeout = float(os.environ.get('VENVPOOL_CREATION_WAIT', 300)) # Released by the kernel if that process dies, but it may hang.
+    mark = time.time()
+    delay = .05
+    f = open(path, 'a')
+    try:
+        while True:
+            try:
+                _osop(fcntl.flock, f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except oserrors[errno.EWOULDBLOCK]:
+                if .05 == delay:
+                    log.info("Wait for concurrent creation of %s.", label)
+                remaining = mark + timeout - time.time()
+                if remaining <= 0:
+                    log.warning("Gave up waiting for concurrent creation of %s after %.3f seconds, create anyway.", label, time.time() - mark)
+                    break
+                time.sleep(min(delay, remaining))
+                delay = min(delay * 2, 1)
+                continue
+            if _isopenedpath(f, path):
+                break
+            f.close() # Pruned while we waited, so lock its replacement.
+            f = open(path, 'a')
+        yield
+    finally:
+        f.close()
+
 class Pip:
 
     envpatch = dict(PYTHON_KEYRING_BACKEND = 'keyring.backends.null.Keyring')
@@ -157,8 +304,29 @@ class Pip:
     def __init__(self, pippath):
         self.pippath = pippath
 
+    def _pip(self, command, **kwargs):
+        subprocess.check_call([self.pippath] + command, env = dict(os.environ, **self.envpatch), stdout = sys.stderr, **kwargs)
+
     def pipinstall(self, command):
-        subprocess.check_call([self.pippath, 'install'] + command, env = dict(os.environ, **self.envpatch), stdout = sys.stderr)
+        self._pip(['install'] + command)
+
+    def wheelhouseinstall(self, wheelhouse, reqstrs):
+        command = ['install', '--no-index', '--find-links', wheelhouse] + reqstrs
+        _makedirs(wheelhouse)
+        p = subprocess.Popen([self.pippath] + command, env = dict(os.environ, **self.envpatch), stdout = sys.stderr, stderr = subprocess.PIPE)
+        stderr = p.communicate()[1]
+        if not p.returncode:
+            return
+        log.debug("Wheelhouse install failed: %s", stderr.decode('utf-8', 'replace').rstrip())
+        log.info('Not satisfied by wheelhouse, add wheels.')
+        tempdir = mkdtemp(dir = os.path.dirname(wheelhouse), prefix = 'wheels') # Same filesystem for atomic rename.
+        try:
+            self._pip(['wheel', '--wheel-dir', tempdir, '--find-links', wheelhouse] + reqstrs)
+            for name in os.listdir(tempdir):
+                os.rename(os.path.join(tempdir, name), os.path.join(wheelhouse, name))
+        finally:
+            shutil.rmtree(tempdir)
+        self._pip(command)
 
 def listorempty(d, xform = lambda p: p):
     try:
@@ -201,15 +369,63 @@ def _chunkify(n, v):
             chunk.append(x)
         yield chunk
 
+def _lsofswept(readlocks):
+    for chunk in _chunkify(1000, readlocks):
+        # Check stderr instead of returncode for errors:
+        stdout, stderr = subprocess.Popen(['lsof', '-t'] + chunk, stdout = subprocess.PIPE, stderr = subprocess.PIPE).communicate()
+        if not stderr and not stdout:
+            for readlock in chunk:
+                if _idempotentunlink(readlock):
+                    yield readlock
+
+def _openfilekeys():
+    keys = set()
+    for pid in os.listdir('/proc'):
+        if pid.isdigit():
+            fddir = os.path.join('/proc', pid, 'fd')
+            try:
+                names = _osop(os.listdir, fddir)
+            except (oserrors[errno.ENOENT], oserrors[errno.EACCES]): # Exited, or other user as with lsof.
+                continue
+            for name in names:
+                try:
+                    st = _osop(os.stat, os.path.join(fddir, name))
+                except (oserrors[errno.ENOENT], oserrors[errno.EACCES]):
+                    continue
+                keys.add((st.st_dev, st.st_ino))
+    return keys
+
+_sweeppasses = []
+
+@contextmanager
+def sweeppass():
+    _sweeppasses.append(None)
+    try:
+        yield
+    finally:
+        _sweeppasses.pop()
+
+def _procswept(readlocks, graceperiod = 1):
+    import time
+    stats = []
+    for readlock in readlocks:
+        try:
+            stats.append((readlock, _osop(os.stat, readlock)))
+        except oserrors[errno.ENOENT]:
+            pass
+    state = _sweeppasses[-1] if _sweeppasses else None
+    # A lock that may postdate the shared scan needs a scan that starts after its stat, its mtime may lag by a clock tick:
+    if state is None or any(st.st_mtime >= state[0] - graceperiod for _, st in stats):
+        state = time.time(), _openfilekeys()
+        if _sweeppasses:
+            _sweeppasses[-1] = state
+    keys = state[1]
+    for readlock, st in stats:
+        if (st.st_dev, st.st_ino) not in keys and _idempotentunlink(readlock):
+            yield readlock
+
 if '/' == os.sep:
-    def _swept(readlocks):
-        for chunk in _chunkify(1000, readlocks):
-            # Check stderr instead of returncode for errors:
-            stdout, stderr = subprocess.Popen(['lsof', '-t'] + chunk, stdout = subprocess.PIPE, stderr = subprocess.PIPE).communicate()
-            if not stderr and not stdout:
-                for readlock in chunk:
-                    if _idempotentunlink(readlock):
-                        yield readlock
+    _swept = _procswept if os.path.isdir('/proc/self/fd') else _lsofswept
 else:
     def _swept(readlocks): # TODO: Untested!
         for readlock in readlocks:
@@ -269,6 +485,9 @@ class SharedDir(object):
         except oserrors[errno.EEXIST]:
             raise LockStateException
 
+    def readlockcount(self):
+        return len(listorempty(self.readlocks)) # Includes any stale ones.
+
     def tryreadlock(self):
         try:
             h = _osop(mkstemp, dir = self.readlocks, prefix = 'lock')[0]
@@ -277,13 +496,143 @@ class SharedDir(object):
         except oserrors[errno.ENOENT]:
             pass
 
+class FcntlSharedDir(object):
+
+    def __init__(self, dirpath):
+        self.lockpath = os.path.join(dirpath, 'lock')
+        self.writehandle = None
+
+    def _tryflockornone(self, operation):
+        import fcntl
+        try:
+            h = _osop(os.open, self.lockpath, os.O_RDONLY)
+        except oserrors[errno.ENOENT]: # Write locked since creation.
+            return
+        try:
+            _osop(fcntl.flock, h, operation | fcntl.LOCK_NB)
+            return h
+        except oserrors[errno.EWOULDBLOCK]:
+            os.close(h)
+
+    def trywritelock(self):
+        import fcntl
+        h = self._tryflockornone(fcntl.LOCK_EX)
+        if h is not None:
+            self.writehandle = h
+            return True
+
+    def createortrywritelock(self):
+        try:
+            _osop(os.mkdir, os.path.dirname(self.lockpath))
+            return True
+        except oserrors[errno.EEXIST]:
+            return self.trywritelock()
+
+    def writeunlock(self):
+        if self.writehandle is None:
+            try:
+                os.close(_osop(os.open, self.lockpath, os.O_WRONLY | os.O_CREAT | os.O_EXCL))
+            except oserrors[errno.EEXIST]:
+                raise LockStateException
+        else:
+            os.close(self.writehandle)
+            self.writehandle = None
+
+    def readlockcount(self):
+        try:
+            st = _osop(os.stat, self.lockpath)
+            with open('/proc/locks') as f:
+                locks = f.read().splitlines()
+        except (oserrors[errno.ENOENT], IOError):
+            return 0
+        key = os.major(st.st_dev), os.minor(st.st_dev), st.st_ino # Inode numbers alone collide across filesystems.
+        n = 0
+        for l in locks:
+            words = l.split() # For example: 1: FLOCK ADVISORY READ 1234 fd:01:5678 0 EOF
+            if 'READ' == words[3]: # Blocked waiters have an arrow in words[1].
+                major, minor, ino = words[5].split(':') # Device numbers in hex.
+                if (int(major, 16), int(minor, 16), int(ino)) == key:
+                    n += 1
+        return n
+
+    def tryreadlock(self):
+        import fcntl
+        h = self._tryflockornone(fcntl.LOCK_SH)
+        if h is not None:
+            set_inheritable(h, True)
+            return ReadLock(h)
+
 def safe_name(name):
     return re.sub('[^A-Za-z0-9.]+', '-', name)
 
 def to_filename(name):
     return name.replace('-', '_')
 
-class Venv(SharedDir):
+def _inventorykey(name):
+    return to_filename(safe_name(name)).lower()
+
+def _makedirs(path):
+    try:
+        _osop(os.makedirs, path)
+    except oserrors[errno.EEXIST]:
+        pass
+
+def _atomicwrite(path, text):
+    h, q = mkstemp(dir = os.path.dirname(path))
+    with _onerror(lambda: os.remove(q)):
+        with os.fdopen(h, 'w') as f:
+            f.write(text)
+        os.rename(q, path)
+
+def _lockbackend(): # Backends do not see each other's locks, so the pool records which one it uses.
+    requested = os.environ.get('VENVPOOL_LOCKS') or None
+    if requested not in {None, 'readlocks', 'fcntl'}:
+        raise ValueError(requested)
+    try:
+        backend = _lockbackends[pooldir]
+    except KeyError:
+        backend = _lockbackends[pooldir] = _recordedlockbackendornone()
+    if backend is None:
+        return requested or 'readlocks'
+    if requested not in {None, backend}:
+        raise ValueError("Pool uses %s locks, not: %s" % (backend, requested))
+    return backend
+
+def _recordedlockbackendornone():
+    try:
+        with os.fdopen(_osop(os.open, os.path.join(pooldir, 'locks'), os.O_RDONLY)) as f:
+            return f.read()
+    except oserrors[errno.ENOENT]:
+        pass
+    for venvpath in (p for d in _versiondirs() for p in listorempty(d)): # Pool predates the record.
+        for backend, name in [['readlocks', 'readlocks'], ['fcntl', 'lock']]:
+            if os.path.exists(os.path.join(venvpath, name)):
+                log.info("Infer %s locks from: %s", backend, venvpath)
+                return _writelockbackend(backend)
+
+def _writelockbackend(backend):
+    _makedirs(pooldir)
+    h, q = mkstemp(dir = pooldir)
+    try:
+        with os.fdopen(h, 'w') as f:
+            f.write(backend)
+        try:
+            _osop(os.link, q, os.path.join(pooldir, 'locks'))
+        except oserrors[errno.EEXIST]:
+            with open(os.path.join(pooldir, 'locks')) as f:
+                return f.read() # A concurrent first writer won.
+    finally:
+        os.remove(q)
+    return backend
+
+def _recordlockbackend():
+    _lockbackends.pop(pooldir, None) # Another process may have recorded it since.
+    backend = _lockbackend()
+    if _lockbackends[pooldir] is None:
+        _lockbackends[pooldir] = _writelockbackend(backend)
+        _lockbackend() # Check the record agrees.
+
+class Venv(object):
 
     @staticmethod
     def _safewhich(name):
@@ -303,8 +652,27 @@ class Venv(SharedDir):
         return os.path.join(libpath, pyname, 'site-packages')
 
     def __init__(self, venvpath):
-        super(Venv, self).__init__(venvpath)
+        self.shareddir = (FcntlSharedDir if 'fcntl' == _lockbackend() else SharedDir)(venvpath)
         self.venvpath = venvpath
+        self.inventorypath = os.path.join(venvpath, 'inventory')
+        self.originpath = os.path.join(venvpath, 'origin')
+        self.lastusepath = os.path.join(venvpath, 'lastuse')
+        self.interpreterpath = os.path.join(venvpath, 'interpreter')
+
+    def trywritelock(self):
+        return self.shareddir.trywritelock()
+
+    def createortrywritelock(self):
+        return self.shareddir.createortrywritelock()
+
+    def writeunlock(self):
+        self.shareddir.writeunlock()
+
+    def readlockcount(self):
+        return self.shareddir.readlockcount()
+
+    def tryreadlock(self):
+        return self.shareddir.tryreadlock()
 
     def create(self, pyversion):
         def isolated(*command):
@@ -324,39 +692,208 @@ class Venv(SharedDir):
 v = [os.path.join(os.path.dirname(sys.executable), sys.argv[1])] + sys.argv[2:]
 os.execv(v[0], v)
 ''')
+        with open(os.path.join(self.site_packages, trampolinerelpath), 'w') as f:
+            f.write(_trampolinesrc())
+
+    def clone(self, venvpath):
+        sourcepath = os.path.abspath(self.venvpath)
+        metadata = set(os.path.basename(p) for p in [self.inventorypath, self.originpath, self.lastusepath, self.interpreterpath]) | {'lock', 'readlocks'}
+        reflink = True
+        for dirpath, dirnames, filenames in os.walk(sourcepath):
+            if dirpath == sourcepath: # Bookkeeping of the source is not the clone's.
+                dirnames[:] = [n for n in dirnames if n not in metadata]
+                filenames = [n for n in filenames if not (n in metadata or n.startswith('zygote'))]
+            targetdir = os.path.join(venvpath, os.path.relpath(dirpath, sourcepath))
+            for name in dirnames + filenames:
+                source = os.path.join(dirpath, name)
+                target = os.path.join(targetdir, name)
+                if os.path.islink(source):
+                    os.symlink(os.readlink(source), target)
+                elif name in dirnames:
+                    os.mkdir(target)
+                elif not (reflink and _reflink(source, target)):
+                    reflink = False
+                    os.link(source, target)
+        venv = Venv(venvpath)
+        with open(venv.originpath, 'w') as f:
+            f.write(sourcepath)
+        venv.relocate()
+
+    def relocate(self):
+        with open(self.originpath) as f:
+            oldpath = f.read()
+        log.debug("Relocate venv from: %s", oldpath)
+        encoding = sys.getfilesystemencoding()
+        old = oldpath.encode(encoding)
+        new = os.path.abspath(self.venvpath).encode(encoding)
+        for path in [os.path.join(self.venvpath, 'pyvenv.cfg')] + listorempty(os.path.join(self.venvpath, 'bin')):
+            if os.path.islink(path) or not os.path.isfile(path):
+                continue
+            with open(path, 'rb') as f:
+                data = f.read()
+            if old in data:
+                h, q = mkstemp(dir = os.path.dirname(path))
+                with _onerror(lambda: os.remove(q)):
+                    with os.fdopen(h, 'wb') as f:
+                        f.write(data.replace(old, new))
+                    shutil.copymode(path, q)
+                    os.rename(q, path)
+        os.remove(self.originpath)
+
+    def touchlastuse(self):
+        try:
+            _osop(os.utime, self.lastusepath, None)
+        except oserrors[errno.ENOENT]:
+            with open(self.lastusepath, 'a'):
+                pass
+
+    def lastuse(self):
+        try:
+            return _osop(os.stat, self.lastusepath).st_mtime
+        except oserrors[errno.ENOENT]:
+            return 0 # Never used.
 
     def delete(self, label = 'transient'):
         log.debug("Delete %s venv: %s", label, self.venvpath)
         shutil.rmtree(self.venvpath)
 
+    @property
+    def zygotepath(self): # The zygote interpreter keeps the settings it started with, so only reuse it for launches with the same ones.
+        from binascii import crc32
+        settings = '\0'.join("%s=%s" % t for t in sorted(os.environ.items()) if t[0].startswith('PYTHON'))
+        return os.path.join(self.venvpath, "zygote%08x" % (crc32(settings.encode('utf-8')) & 0xffffffff))
+
+    def callzygoteornone(self, localreqs, module, scriptargs):
+        from array import array
+        import signal, socket
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            _osop(sock.connect, self.zygotepath)
+        except (oserrors[errno.ENOENT], oserrors[errno.ECONNREFUSED]):
+            sock.close()
+            return
+        with sock:
+            try:
+                _osop(sock.sendmsg, [b'\0'.join(os.fsencode(f) for f in [os.getcwd(), os.pathsep.join(_compress(localreqs)), module, str(len(scriptargs))] + scriptargs + ["%s=%s" % t for t in os.environ.items()])], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array('i', [0, 1, 2]))])
+                _osop(sock.shutdown, socket.SHUT_WR)
+                f = sock.makefile('rb')
+                pid = int(_osop(f.readline))
+            except (oserrors[errno.ECONNRESET], oserrors[errno.EPIPE], oserrors[errno.ENOTCONN], ValueError): # Zygote timed out before accepting, so nothing ran.
+                log.debug('Zygote went away.', exc_info = True)
+                return
+            log.debug("Zygote child: %s", pid)
+            def forward(signum, frame):
+                os.kill(pid, signum)
+            for signum in signal.SIGHUP, signal.SIGINT, signal.SIGTERM:
+                signal.signal(signum, forward)
+            line = f.readline()
+            return int(line) if line else 1 # Child killed.
+
+    def startzygote(self, idle):
+        lock = self.tryreadlock() # The zygote's own lock.
+        if lock is None:
+            return
+        try:
+            _detach([self.programpath('python'), _stripc(__file__), '-Z', self.zygotepath, str(lock.handle), str(idle)], pass_fds = [lock.handle])
+        finally:
+            lock.unlock()
+
     def programpath(self, name):
         return os.path.join(self.venvpath, 'bin', name)
 
-    def install(self, args):
+    def install(self, args, wheelhouse = None):
         log.debug("Install: %s", ' '.join(args))
         if args:
-            Pip(self.programpath('pip')).pipinstall(args)
+            pip = Pip(self.programpath('pip'))
+            if wheelhouse is None:
+                pip.pipinstall(args)
+                return
+            if os.environ.get('VENVPOOL_LINKINSTALL'):
+                pyname = os.path.basename(os.path.dirname(self.site_packages))
+                wheelpaths = WheelStore.resolveornone(wheelhouse, args, self.inventory(), {'py' + pyname[6:7], 'py' + pyname[6:].replace('.', '')})
+                if wheelpaths is not None:
+                    WheelStore(os.path.join(os.path.dirname(wheelhouse), 'store')).install(self, wheelpaths)
+                    return
+                log.info('Not resolvable from pure wheels in wheelhouse, use pip.')
+            pip.wheelhouseinstall(wheelhouse, args)
 
     def compatible(self, installdeps):
+        inventory = self.inventory()
         for r in installdeps.pypireqs:
-            version = self._reqversionornone(r.namepart)
+            version = inventory.get(_inventorykey(r.namepart))
             if version is None or not r.acceptversion(version):
                 return
         log.debug("Found compatible venv: %s", self.venvpath)
         return True
 
-    def _reqversionornone(self, name):
-        patterns = [re.compile(format % nameregex) for nameregex in [re.escape(to_filename(safe_name(name)).lower())] for format in [
-            "^%s-(.+)[.]dist-info$",
-            "^%s-([^-]+).*[.]egg-info$"]]
-        for lowername in (n.lower() for n in os.listdir(self.site_packages)):
+    def inventory(self):
+        try:
+            with os.fdopen(_osop(os.open, self.inventorypath, os.O_RDONLY)) as f:
+                relpath = f.readline()[:-1]
+                mtime = f.readline()[:-1]
+                if repr(_osop(os.stat, os.path.join(self.venvpath, relpath)).st_mtime) == mtime:
+                    return dict(l.split() for l in f)
+        except oserrors[errno.ENOENT]:
+            pass
+        return self._scaninventory()[2] # Not written, as we may not hold the write lock.
+
+    def _scaninventory(self):
+        sitepath = self.site_packages
+        mtime = os.stat(sitepath).st_mtime # Before listing so that concurrent changes make it stale.
+        inventory = {}
+        patterns = [re.compile(r) for r in inventoryregexes]
+        for lowername in sorted(n.lower() for n in os.listdir(sitepath)):
             for p in patterns:
                 m = p.search(lowername)
                 if m is not None:
-                    return m.group(1)
+                    inventory.setdefault(*m.groups())
+                    break
+        return sitepath, mtime, inventory
+
+    def updateinventory(self): # Caller must hold the write lock.
+        sitepath, mtime, inventory = self._scaninventory()
+        _atomicwrite(self.inventorypath, "%s\n%r\n%s" % (os.path.relpath(sitepath, self.venvpath), mtime, ''.join("%s %s\n" % t for t in sorted(inventory.items()))))
+        return inventory
+
+    def _recordpathsornone(self, distnames):
+        import csv
+        sitepath = self.site_packages
+        inventory = self.inventory()
+        pattern = re.compile(inventoryregexes[0])
+        distinfos = {}
+        for name in os.listdir(sitepath):
+            m = pattern.search(name.lower())
+            if m is not None:
+                distinfos[m.group(1)] = name
+        paths = []
+        for key in set(_inventorykey(n) for n in distnames):
+            if key not in inventory:
+                continue # Nothing to unshare.
+            try:
+                f = os.fdopen(_osop(os.open, os.path.join(sitepath, distinfos[key], 'RECORD'), os.O_RDONLY))
+            except (KeyError, oserrors[errno.ENOENT]):
+                return # For example egg-info.
+            with f:
+                paths.extend(os.path.normpath(os.path.join(sitepath, row[0])) for row in csv.reader(f) if row)
+        return paths
+
+    def unshare(self, distnames = None):
+        from multiprocessing.pool import ThreadPool
+        paths = None if distnames is None else self._recordpathsornone(distnames)
+        if paths is None:
+            paths = [os.path.join(dirpath, name) for dirpath, _, filenames in os.walk(self.venvpath) for name in filenames]
+        pool = ThreadPool()
+        try:
+            pool.map(_unsharefile, paths)
+        finally:
+            pool.close()
+            pool.join()
 
     def run(self, mode, localreqs, module, scriptargs, **kwargs):
-        argv = [os.path.join(self.venvpath, 'bin', 'python'), _stripc(__file__), '-X', os.pathsep.join(_compress(localreqs)), module] + scriptargs
+        trampolinepath = os.path.join(self.site_packages, trampolinerelpath)
+        if not os.path.exists(trampolinepath): # Venv predates trampoline.
+            trampolinepath = _stripc(__file__)
+        argv = [os.path.join(self.venvpath, 'bin', 'python'), trampolinepath, '-X', os.pathsep.join(_compress(localreqs)), module] + scriptargs
         if 'call' == mode:
             return subprocess.call(argv, **kwargs)
         if 'check_call' == mode:
@@ -367,6 +904,115 @@ os.execv(v[0], v)
             os.execv(argv[0], argv, **kwargs)
         raise ValueError(mode)
 
+def _versiondirs():
+    return [p for p in listorempty(pooldir) if os.path.basename(p).isdigit()]
+
+def _prunecreationlocks():
+    try:
+        import fcntl
+    except ImportError:
+        return
+    for creationdir in listorempty(os.path.join(pooldir, 'creation')):
+        for path in listorempty(creationdir):
+            try:
+                h = _osop(os.open, path, os.O_RDONLY)
+            except oserrors[errno.ENOENT]:
+                continue
+            try:
+                _osop(fcntl.flock, h, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                _idempotentunlink(path) # Waiters notice and lock a fresh file.
+            except oserrors[errno.EWOULDBLOCK]:
+                pass
+            finally:
+                os.close(h)
+
+def _prunebookkeeping():
+    _prunecreationlocks()
+    for aliasesdir in listorempty(os.path.join(pooldir, 'aliases')):
+        for aliasdir in listorempty(aliasesdir):
+            for path in listorempty(aliasdir):
+                if not os.path.exists(path):
+                    _idempotentunlink(path)
+            try:
+                _osop(os.rmdir, aliasdir)
+            except (oserrors[errno.ENOTEMPTY], oserrors[errno.EEXIST], oserrors[errno.ENOENT]):
+                pass
+
+def _trampolinesrc():
+    from inspect import getsource # Expensive, but only needed when creating a venv.
+    return "import os, sys\n\n%s\nclass Execute:\n\n%s\n%s\nExecute.main()\n" % (getsource(_decompress), getsource(Execute.main), getsource(Execute._insertionpoint))
+
+def _reflink(source, target, FICLONE = 0x40049409):
+    try:
+        from fcntl import ioctl
+    except ImportError:
+        return
+    with open(source, 'rb') as f:
+        h = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_EXCL, os.fstat(f.fileno()).st_mode & 0o7777)
+        try:
+            ioctl(h, FICLONE, f.fileno())
+            return True
+        except (IOError, OSError) as e:
+            if e.errno not in {errno.EINVAL, errno.ENOTTY, errno.EOPNOTSUPP, errno.EXDEV}:
+                raise
+        finally:
+            os.close(h)
+    os.remove(target)
+
+def _unsharefile(path):
+    try:
+        st = _osop(os.lstat, path)
+    except oserrors[errno.ENOENT]: # Listed in RECORD but gone.
+        return
+    if not S_ISREG(st.st_mode) or 1 == st.st_nlink:
+        return
+    h, q = mkstemp(dir = os.path.dirname(path))
+    os.close(h)
+    os.remove(q) # Reflink wants a new file.
+    if _reflink(path, q):
+        shutil.copystat(path, q)
+    else:
+        shutil.copy2(path, q)
+    os.remove(path) # Cross-platform.
+    os.rename(q, path)
+
+def _filedigest(path):
+    h = sha256()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(0x10000)
+            if not block:
+                return h.hexdigest()
+            h.update(block)
+
+def _detach(command, **kwargs):
+    if sys.version_info.major < 3:
+        kwargs['preexec_fn'] = os.setsid
+        if kwargs.pop('pass_fds', None):
+            kwargs['close_fds'] = False # Handles to pass are already inheritable.
+    else:
+        kwargs['start_new_session'] = True
+    with open(os.devnull, 'r+') as f:
+        subprocess.Popen(command, stdin = f, stdout = f, stderr = f, **kwargs)
+
+def _awaitchange(dirpaths, timeout, IN_CREATE = 0x100, IN_CLOSE_NOWRITE = 0x10, IN_DELETE_SELF = 0x400, IN_MOVE_SELF = 0x800, IN_CLOEXEC = 0o2000000):
+    try:
+        import ctypes, select
+        libc = ctypes.CDLL(None, use_errno = True)
+        h = libc.inotify_init1(IN_CLOEXEC)
+    except (AttributeError, OSError):
+        h = -1
+    if h < 0:
+        import time
+        time.sleep(timeout) # Caller backs off.
+        return
+    try:
+        for dirpath in dirpaths:
+            libc.inotify_add_watch(h, os.path.abspath(dirpath).encode(sys.getfilesystemencoding()), IN_CREATE | IN_CLOSE_NOWRITE | IN_DELETE_SELF | IN_MOVE_SELF)
+        select.select([h], [], [], timeout)
+    finally:
+        os.close(h)
+
 def _stripc(path):
     return path[:-1] if 'c' == path[-1] else path
 
@@ -376,7 +1022,7 @@ class Pool:
     def versiondir(self):
         return os.path.join(pooldir, str(self.pyversion))
 
-    def __init__(self, pyversion):
+    def __init__(self, pyversion, policy = None):
         self.readonlyortransient = {
             False: self.readonly,
             True: self._transient,
@@ -386,31 +1032,285 @@ class Pool:
             True: self.readwrite,
         }
         self.pyversion = pyversion
+        self.policy = policy or os.environ.get('VENVPOOL_POLICY', 'random')
+        if self.policy not in {'random', 'mru', 'fewest', 'idle'}:
+            raise ValueError(self.policy)
 
-    def _newvenv(self, installdeps):
-        log.info('Create new venv.')
+    @property
+    def indexpath(self):
+        return os.path.join(pooldir, 'index', str(self.pyversion))
+
+    @property
+    def templatepath(self):
+        return os.path.join(pooldir, 'template', str(self.pyversion))
+
+    def _interpreter(self):
+        executable = Venv._safewhich("python%s" % self.pyversion)
+        if executable is None:
+            return "python%s" % self.pyversion # Not found, so no venv can be created anyway.
+        realpath = os.path.realpath(executable)
+        return "%s\n%s\n%s" % (executable, realpath, _statkey(realpath)) # Realpaths alone miss shims, virtualenv copies and upgrades in place.
+
+    def _fingerprint(self, installdeps):
+        return installdeps.fingerprint(self._interpreter())
+
+    def _linkedtemplateornone(self):
         try:
-            _osop(os.makedirs, self.versiondir)
-        except oserrors[errno.EEXIST]:
+            return Venv(os.path.join(os.path.dirname(self.templatepath), _osop(os.readlink, self.templatepath)))
+        except oserrors[errno.ENOENT]:
             pass
-        venv = Venv(mkdtemp(dir = self.versiondir, prefix = 'venv'))
-        with _onerror(venv.delete):
+
+    @staticmethod
+    def _iscurrent(venv, interpreter):
+        try:
+            with os.fdopen(_osop(os.open, venv.interpreterpath, os.O_RDONLY)) as f:
+                return f.read() == interpreter
+        except oserrors[errno.ENOENT]:
+            return False
+
+    def _template(self):
+        interpreter = self._interpreter()
+        template = self._linkedtemplateornone()
+        if template is not None and self._iscurrent(template, interpreter):
+            return template
+        with _boundedflock(os.path.join(pooldir, 'creation', str(self.pyversion), 'template'), 'template venv'):
+            template = self._linkedtemplateornone() # Another creator may have won the race.
+            if template is not None:
+                if self._iscurrent(template, interpreter):
+                    return template
+                log.info("Stale template venv: %s", template.venvpath)
+            log.info('Create template venv.')
+            templatesdir = os.path.dirname(self.templatepath)
+            _makedirs(templatesdir)
+            newtemplate = Venv(mkdtemp(dir = templatesdir, prefix = 'venv'))
+            with _onerror(newtemplate.delete):
+                newtemplate.create(self.pyversion)
+                with open(newtemplate.interpreterpath, 'w') as f:
+                    f.write(interpreter)
+                linkpath = "%s.%s" % (self.templatepath, os.getpid())
+                os.symlink(os.path.basename(newtemplate.venvpath), linkpath)
+                os.rename(linkpath, self.templatepath)
+            if template is not None:
+                template.delete('stale template') # Concurrent clones will fall back.
+            return newtemplate
+
+    def _create(self, venv):
+        try:
+            self._template().clone(venv.venvpath)
+        except Exception:
+            log.warning('Failed to clone template, create from scratch.', exc_info = True)
+            shutil.rmtree(venv.venvpath)
+            os.mkdir(venv.venvpath)
             venv.create(self.pyversion)
+        with open(venv.interpreterpath, 'w') as f:
+            f.write(self._interpreter())
+
+    @property
+    def sparedir(self):
+        return os.path.join(pooldir, 'spare', str(self.pyversion))
+
+    def _sparecount(self):
+        try:
+            with os.fdopen(_osop(os.open, os.path.join(self.sparedir, 'count'), os.O_RDONLY)) as f:
+                return int(f.read())
+        except oserrors[errno.ENOENT]:
+            return 0
+
+    def fillspares(self, n = None):
+        import fcntl
+        if n is not None:
+            _makedirs(self.sparedir)
+            _atomicwrite(os.path.join(self.sparedir, 'count'), "%s\n" % n)
+        while len(self._spares()) < self._sparecount(): # Check again after unlock in case we turned away a fill.
+            with open(os.path.join(self.sparedir, 'fill'), 'a') as lockfile:
+                try:
+                    _osop(fcntl.flock, lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except oserrors[errno.EWOULDBLOCK]:
+                    log.debug('Spares already being filled.')
+                    return
+                while len(self._spares()) < self._sparecount():
+                    log.info('Create spare venv.')
+                    venv = Venv(mkdtemp(dir = self.sparedir, prefix = 'partial'))
+                    with _onerror(venv.delete):
+                        self._create(venv)
+                        with open(venv.originpath, 'w') as f:
+                            f.write(os.path.abspath(venv.venvpath))
+                        os.rename(venv.venvpath, mkdtemp(dir = self.sparedir, prefix = 'spare')) # Only now visible as a spare.
+
+    def _spares(self):
+        return [p for p in listorempty(self.sparedir) if os.path.basename(p).startswith('spare')]
+
+    def _claimspareornone(self):
+        interpreter = None
+        for path in self._spares():
+            if interpreter is None:
+                interpreter = self._interpreter()
+            venv = Venv(mkdtemp(dir = self.versiondir, prefix = 'venv'))
+            try:
+                _osop(os.rename, path, venv.venvpath)
+            except oserrors[errno.ENOENT]:
+                log.debug("Already claimed: %s", path)
+                os.rmdir(venv.venvpath)
+                continue
+            if not self._iscurrent(venv, interpreter): # Safe to delete now that we own it.
+                venv.delete('stale spare')
+                continue
+            log.info("Claimed spare venv: %s", path)
+            with _onerror(venv.delete):
+                venv.relocate()
+            return venv
+
+    @property
+    def aliasesdir(self):
+        return os.path.join(pooldir, 'aliases', str(self.pyversion))
+
+    def _alias(self, installdeps, venv):
+        aliasdir = os.path.join(self.aliasesdir, self._fingerprint(installdeps))
+        name = os.path.basename(venv.venvpath)
+        while True:
+            _makedirs(aliasdir)
+            try:
+                _osop(os.symlink, os.path.join(os.pardir, os.pardir, os.pardir, str(self.pyversion), name), os.path.join(aliasdir, name))
+            except oserrors[errno.EEXIST]:
+                pass
+            except oserrors[errno.ENOENT]:
+                continue # Empty dir pruned concurrently.
+            break
+
+    def _lockaliasedvenvornone(self, installdeps):
+        aliasdir = os.path.join(self.aliasesdir, self._fingerprint(installdeps))
+        for venv in self._ordered([Venv(os.path.join(self.versiondir, os.path.basename(p))) for p in listorempty(aliasdir)]):
+            lock = venv.tryreadlock()
+            if lock is not None:
+                with _onerror(lock.unlock):
+                    if venv.compatible(installdeps): # Its packages may have changed since.
+                        return venv, lock
+                lock.unlock()
+            elif not os.path.exists(venv.venvpath):
+                _idempotentunlink(os.path.join(aliasdir, os.path.basename(venv.venvpath)))
+
+    def _newvenv(self, installdeps):
+        _recordlockbackend()
+        _makedirs(self.versiondir)
+        venv = self._claimspareornone()
+        claimed = venv is not None
+        if not claimed:
+            log.info('Create new venv.')
+            venv = Venv(mkdtemp(dir = self.versiondir, prefix = 'venv'))
+            with _onerror(venv.delete):
+                self._create(venv)
+        with _onerror(venv.delete):
             installdeps.invoke(venv)
+            self._updated(venv)
             assert venv.compatible(installdeps) # Bug if not.
-            return venv
+            self._alias(installdeps, venv)
+        if claimed:
+            try:
+                _detach([sys.executable, _stripc(__file__), '-P', '--pyversion', str(self.pyversion)]) # Refill off the critical path.
+            except Exception:
+                log.warning('Failed to start spare refill.', exc_info = True)
+        return venv
+
+    def _updated(self, venv):
+        venv.updateinventory()
+        os.utime(self.versiondir, None) # Invalidate index.
+
+    def _loadindex(self):
+        try:
+            mtime = repr(_osop(os.stat, self.versiondir).st_mtime)
+        except oserrors[errno.ENOENT]:
+            return [], {}
+        try:
+            with os.fdopen(_osop(os.open, self.indexpath, os.O_RDONLY)) as f:
+                if f.readline()[:-1] == mtime:
+                    return f.readline().split(), dict(l.split(' ', 1) for l in f)
+        except oserrors[errno.ENOENT]:
+            pass
+        return self._updateindex()
+
+    def _updateindex(self):
+        mtime = os.stat(self.versiondir).st_mtime # Before listing so that concurrent changes make it stale.
+        names = []
+        keytoentries = {}
+        for venv in listorempty(self.versiondir, Venv):
+            try:
+                inventory = venv.inventory()
+            except (OSError, ValueError): # Most likely still being created.
+                log.debug("Not indexable: %s", venv.venvpath)
+                continue
+            name = os.path.basename(venv.venvpath)
+            names.append(name)
+            for key, version in inventory.items():
+                keytoentries.setdefault(key, []).append("%s=%s" % (name, version))
+        index = {key: ' '.join(entries) for key, entries in keytoentries.items()}
+        _makedirs(os.path.dirname(self.indexpath))
+        _atomicwrite(self.indexpath, "%r\n%s\n%s" % (mtime, ' '.join(names), ''.join("%s %s\n" % t for t in sorted(index.items()))))
+        return names, index
+
+    def _candidates(self, installdeps):
+        names, index = self._loadindex()
+        candidates = set(names)
+        for r in installdeps.pypireqs:
+            if not candidates:
+                break
+            candidates.intersection_update(name for name, version in (e.split('=', 1) for e in index.get(_inventorykey(r.namepart), '').split()) if r.acceptversion(version))
+        return [Venv(os.path.join(self.versiondir, name)) for name in sorted(candidates)]
+
+    def _policykeyornone(self):
+        if 'mru' == self.policy:
+            return lambda venv: -venv.lastuse()
+        if 'fewest' == self.policy:
+            counts = {}
+            for entries in self._loadindex()[1].values():
+                for e in entries.split():
+                    name = e.split('=', 1)[0]
+                    counts[name] = counts.get(name, 0) + 1
+            return lambda venv: counts.get(os.path.basename(venv.venvpath), 0)
+        if 'idle' == self.policy:
+            # XXX: With the readlocks backend this lists each candidate's readlocks, stale ones included, the fcntl backend is exact:
+            return lambda venv: venv.readlockcount()
+
+    def _ordered(self, venvs):
+        shuffle(venvs) # Break ties randomly.
+        key = self._policykeyornone()
+        if key is not None:
+            venvs.sort(key = key)
+        return venvs
 
     def _lockcompatiblevenv(self, trylock, installdeps):
-        venvs = listorempty(self.versiondir, Venv)
-        shuffle(venvs)
-        for venv in venvs:
+        for venv in self._ordered(self._candidates(installdeps)):
             lock = trylock(venv)
             if lock is not None:
                 with _onerror(lock.unlock):
-                    if venv.compatible(installdeps): # TODO: Upgrade venv if it has a subset.
+                    if venv.compatible(installdeps):
                         return venv, lock
                 lock.unlock()
 
+    def _upgradedornone(self, installdeps):
+        names, index = self._loadindex()
+        scores = dict.fromkeys(names, 0)
+        conflicts = set()
+        for r in installdeps.pypireqs:
+            for name, version in (e.split('=', 1) for e in index.get(_inventorykey(r.namepart), '').split()):
+                if r.acceptversion(version):
+                    scores[name] += 1
+                else:
+                    conflicts.add(name)
+        for score, name in sorted((-score, name) for name, score in scores.items() if score and name not in conflicts):
+            venv = Venv(os.path.join(self.versiondir, name))
+            if not venv.trywritelock():
+                continue
+            log.info("Upgrade venv that has %s of %s requirements: %s", -score, len(installdeps.pypireqs), venv.venvpath)
+            with _onerror(venv.writeunlock):
+                venv.unshare()
+                installdeps.invoke(venv) # Satisfied requirements are left alone.
+                self._updated(venv)
+            if venv.compatible(installdeps):
+                return venv
+            log.warning("Upgrade was not enough: %s", venv.venvpath)
+            venv.writeunlock()
+            return
+
     @contextmanager
     def _transient(self, installdeps):
         venv = self._newvenv(installdeps)
@@ -420,83 +1320,268 @@ class Pool:
             venv.delete()
 
     @contextmanager
-    def readonly(self, installdeps):
+    def _creationlock(self, installdeps):
+        with _boundedflock(os.path.join(pooldir, 'creation', str(self.pyversion), self._fingerprint(installdeps)), 'compatible venv'):
+            yield
+
+    def _awaitcompatiblevenvornone(self, installdeps):
+        import time
+        timeout = float(os.environ.get('VENVPOOL_WAIT', 10))
+        mark = time.time()
+        delay = .05
         while True:
+            venvs = self._candidates(installdeps)
+            if not venvs:
+                return
+            remaining = mark + timeout - time.time()
+            if remaining <= 0:
+                log.info("Gave up waiting for write locked venvs after %.3f seconds.", time.time() - mark)
+                return
+            _awaitchange([venv.venvpath for venv in venvs], min(delay, remaining))
+            delay *= 2
             t = self._lockcompatiblevenv(Venv.tryreadlock, installdeps)
+            if t is not None:
+                log.info("Waited %.3f seconds for write locked venv.", time.time() - mark)
+                return t
+
+    @contextmanager
+    def readonly(self, installdeps):
+        created = False
+        while True:
+            t = self._lockaliasedvenvornone(installdeps)
+            if t is None:
+                t = self._lockcompatiblevenv(Venv.tryreadlock, installdeps)
+                if t is not None:
+                    self._alias(installdeps, t[0]) # Next time no probe.
+            if t is None:
+                t = self._awaitcompatiblevenvornone(installdeps)
             if t is not None:
                 venv, readlock = t
                 break
-            venv = self._newvenv(installdeps)
-            # XXX: Would it be possible to atomically convert write lock to read lock?
-            venv.writeunlock()
-            readlock = venv.tryreadlock()
+            with self._creationlock(installdeps):
+                t = self._lockcompatiblevenv(Venv.tryreadlock, installdeps) # Maybe created while we waited.
+                if t is not None:
+                    venv, readlock = t
+                    break
+                venv = self._upgradedornone(installdeps) if os.environ.get('VENVPOOL_UPGRADE') else None
+                if venv is None:
+                    venv = self._newvenv(installdeps)
+                    created = True
+                # XXX: Would it be possible to atomically convert write lock to read lock?
+                venv.writeunlock()
+                readlock = venv.tryreadlock()
             if readlock is not None:
                 break
+        venv.touchlastuse() # Not the venv dir mtime, as locking changes that.
+        if created and (os.environ.get('VENVPOOL_EVICT_BYTES') or os.environ.get('VENVPOOL_EVICT_COUNT')):
+            _detach([sys.executable, _stripc(__file__), '-E'])
         try:
             yield venv
         finally:
             readlock.unlock()
 
     @contextmanager
-    def readwrite(self, installdeps):
+    def readwrite(self, installdeps, distnames = None):
         def trywritelock(venv):
             if venv.trywritelock():
                 class WriteLock:
                     def unlock(self):
                         venv.writeunlock()
                 return WriteLock()
-        t = self._lockcompatiblevenv(trywritelock, installdeps)
+        with sweeppass():
+            t = self._lockcompatiblevenv(trywritelock, installdeps)
         if t is None:
             venv = self._newvenv(installdeps)
         else:
             venv = t[0]
             with _onerror(venv.writeunlock):
-                for dirpath, dirnames, filenames in os.walk(venv.venvpath):
-                    for name in filenames:
-                        p = os.path.join(dirpath, name)
-                        if 1 != os.stat(p).st_nlink:
-                            h, q = mkstemp(dir = dirpath)
-                            os.close(h)
-                            shutil.copy2(p, q)
-                            os.remove(p) # Cross-platform.
-                            os.rename(q, p)
+                venv.unshare(distnames)
         try:
             yield venv
         finally:
-            venv.writeunlock()
-
-class FastReq:
-
-    class Version:
-
-        def __init__(self, operator, splitversion):
-            self.operator = operator
-            self.splitversion = splitversion
+            try:
+                self._updated(venv)
+            finally:
+                venv.writeunlock()
 
-        def accept(self, splitversion):
-            def pad(v):
-                return v + [0] * (n - len(v))
-            versions = [splitversion, self.splitversion]
-            n = max(map(len, versions))
-            return self.operator(*map(pad, versions))
+def _parseversionkeyornone(versionstr, prephases = dict(a = 0, alpha = 0, b = 1, beta = 1, c = 2, rc = 2, pre = 2, preview = 2)):
+    m = re.search(versionkeyregex, versionstr, re.IGNORECASE)
+    if m is None:
+        return
+    epoch, release, prel, pren, implicitpost, postl, postn, devl, devn, local = m.groups()
+    release = [int(k) for k in release.split('.')]
+    while release and not release[-1]:
+        release.pop()
+    post = implicitpost if postl is None else postn or '0'
+    # Every part is a tuple of ints or of int-led tuples, so keys never compare ints with strs:
+    if prel is not None:
+        prekey = 0, prephases[prel.lower()], int(pren or 0)
+    elif post is None and devl is not None:
+        prekey = -1, # Before any pre-release of the same release.
+    else:
+        prekey = 1,
+    postkey = (-1,) if post is None else (0, int(post))
+    devkey = (1,) if devl is None else (0, int(devn or 0))
+    localkey = () if local is None else tuple((1, int(k)) if k.isdigit() else (0, k.lower()) for k in re.split('[-_.]', local))
+    return int(epoch or 0), tuple(release), prekey, postkey, devkey, localkey
 
-    class DevSegment:
+_versionkeys = OrderedDict()
 
-        def __init__(self, n):
-            self.n = n
+def _versionkey(versionstr, maxsize = 10000):
+    try:
+        key = _versionkeys.pop(versionstr)
+    except KeyError:
+        key = _parseversionkeyornone(versionstr)
+        if len(_versionkeys) >= maxsize:
+            _versionkeys.popitem(last = False)
+    _versionkeys[versionstr] = key # Now most recent.
+    return key
+
+def _publickey(key):
+    return key[:5] + ((),)
+
+def _isprerelease(key):
+    return (1,) != key[2] or (1,) != key[4]
+
+def _eqspec(versionstr, key, speckey):
+    return (key if speckey[5] else _publickey(key)) == speckey
+
+def _nespec(versionstr, key, speckey):
+    return not _eqspec(versionstr, key, speckey)
+
+def _lespec(versionstr, key, speckey):
+    return _publickey(key) <= speckey
+
+def _gespec(versionstr, key, speckey):
+    return _publickey(key) >= speckey
+
+def _ltspec(versionstr, key, speckey):
+    return key < speckey and (_isprerelease(speckey) or not _isprerelease(key) or key[:2] != speckey[:2])
+
+def _gtspec(versionstr, key, speckey):
+    if key <= speckey:
+        return False
+    if key[:2] == speckey[:2]: # Same base version.
+        return not key[5] and ((-1,) != speckey[3] or (-1,) == key[3])
+    return True
+
+def _prefixspec(versionstr, key, epochandprefix):
+    epoch, prefix = epochandprefix
+    release = key[1] + (0,) * (len(prefix) - len(key[1]))
+    return key[0] == epoch and release[:len(prefix)] == prefix
+
+def _notprefixspec(versionstr, key, epochandprefix):
+    return not _prefixspec(versionstr, key, epochandprefix)
+
+def _compatiblespec(versionstr, key, speckeyandprefix):
+    speckey, epochandprefix = speckeyandprefix
+    return _gespec(versionstr, key, speckey) and _prefixspec(versionstr, key, epochandprefix)
+
+def _arbitraryspec(versionstr, key, lowerversionstr):
+    return versionstr.lower() == lowerversionstr
+
+_legacymarkernames = {
+    'os.name': 'os_name',
+    'sys.platform': 'sys_platform',
+    'platform.version': 'platform_version',
+    'platform.machine': 'platform_machine',
+    'platform.python_implementation': 'platform_python_implementation',
+    'python_implementation': 'platform_python_implementation',
+}
+
+def _markervalue(name):
+    name = _legacymarkernames.get(name, name)
+    if 'os_name' == name:
+        return os.name
+    if 'sys_platform' == name:
+        return sys.platform
+    if 'python_version' == name:
+        return "%s.%s" % sys.version_info[:2]
+    if 'implementation_name' == name:
+        return sys.implementation.name if hasattr(sys, 'implementation') else ''
+    if 'implementation_version' == name:
+        if not hasattr(sys, 'implementation'):
+            return '0'
+        v = sys.implementation.version
+        return "%s.%s.%s%s" % (v.major, v.minor, v.micro, '' if 'final' == v.releaselevel else "%s%s" % (v.releaselevel[0], v.serial))
+    if 'extra' == name:
+        return ''
+    import platform # Only for the rarer variables.
+    try:
+        f = dict(
+            platform_machine = platform.machine,
+            platform_python_implementation = platform.python_implementation,
+            platform_release = platform.release,
+            platform_system = platform.system,
+            platform_version = platform.version,
+            python_full_version = platform.python_version,
+        )[name]
+    except KeyError:
+        raise ValueError(name)
+    return f()
+
+_markerresults = {}
+
+def _evaluatemarker(marker):
+    try:
+        return _markerresults[marker]
+    except KeyError:
+        pass
+    tokens = []
+    end = 0
+    for m in re.finditer(r"\s*(%s)" % FastReq.markertokenregex, marker):
+        if m.start() != end:
+            raise ValueError(marker)
+        tokens.append(m.group(1))
+        end = m.end()
+    if marker[end:].strip():
+        raise ValueError(marker)
+    tokens.reverse()
+    def value():
+        token = tokens.pop()
+        return token[1:-1] if token[0] in '\'"' else _markervalue(token)
+    def atom():
+        if '(' == tokens[-1]:
+            tokens.pop()
+            result = disjunction()
+            if ')' != tokens.pop():
+                raise ValueError(marker)
+            return result
+        lhs = value()
+        op = tokens.pop()
+        if 'not' == op:
+            op = "not %s" % tokens.pop()
+        return FastReq.comparemarkervalues(lhs, op, value())
+    def conjunction():
+        result = atom()
+        while tokens and 'and' == tokens[-1]:
+            tokens.pop()
+            result = atom() and result
+        return result
+    def disjunction():
+        result = conjunction()
+        while tokens and 'or' == tokens[-1]:
+            tokens.pop()
+            result = conjunction() or result
+        return result
+    result = disjunction()
+    if tokens:
+        raise ValueError(marker)
+    _markerresults[marker] = result
+    return result
 
-    @classmethod
-    def _splitversion(cls, versionstr, devprefix = 'dev'):
-        return [cls.DevSegment(int(k[len(devprefix):])) if k.startswith(devprefix) else int(k) for k in versionstr.split('.')]
+class FastReq:
 
     s = r'\s*'
     nameregex = '[A-Za-z0-9._-]+' # Slightly more lenient than PEP 508.
     extras = r"\[{s}(?:{nameregex}{s}(?:,{s}{nameregex}{s})*)?]".format(**locals())
-    version = "(<|<=|!=|==|>=|>){s}([0-9.]+(?:[.]dev[0-9]+)?)".format(**locals()) # Subset of features.
+    version = "(~=|===|==|!=|<=|>=|<|>){s}([A-Za-z0-9_.!+*-]+)".format(**locals()) # Checked by _specifier.
     versionregex = "^{s}{version}{s}$".format(**locals())
-    getregex = "^{s}({nameregex}){s}({extras}{s})?({version}{s}(?:,{s}{version}{s})*)?$".format(**locals())
+    versions = "{version}{s}(?:,{s}{version}{s})*".format(**locals())
+    getregex = r"^{s}({nameregex}){s}({extras}{s})?(\({s}{versions}\){s}|{versions})?(?:;{s}(.*?){s})?$".format(**locals())
     skipregex = "^{s}(?:#|$)".format(**locals())
-    del s, extras, version
+    markertokenregex = r"""\(|\)|===|==|!=|<=|>=|~=|<|>|'[^']*'|"[^"]*"|[A-Za-z_][A-Za-z0-9_.]*"""
+    del s, extras, version, versions
     operators = {
         '<': operator.lt,
         '<=': operator.le,
@@ -504,24 +1589,70 @@ class FastReq:
         '==': operator.eq,
         '>=': operator.ge,
         '>': operator.gt,
+        'in': lambda a, b: a in b,
+        'not in': lambda a, b: a not in b,
+    }
+    specifiers = {
+        '<': _ltspec,
+        '<=': _lespec,
+        '!=': _nespec,
+        '==': _eqspec,
+        '>=': _gespec,
+        '>': _gtspec,
     }
 
+    @classmethod
+    def _specifierornone(cls, operatorstr, versionstr):
+        if '===' == operatorstr:
+            return _arbitraryspec, versionstr.lower()
+        if operatorstr in {'==', '!='} and versionstr.endswith('.*'):
+            m = re.search(versionkeyregex, versionstr[:-2], re.IGNORECASE)
+            if m is not None and not any(m.groups()[2:]): # Release only.
+                return {'==': _prefixspec, '!=': _notprefixspec}[operatorstr], (int(m.group(1) or 0), tuple(int(k) for k in m.group(2).split('.')))
+            return
+        speckey = _versionkey(versionstr)
+        if speckey is None:
+            return
+        if '~=' == operatorstr:
+            release = re.search(versionkeyregex, versionstr, re.IGNORECASE).group(2).split('.')
+            if 2 <= len(release):
+                return _compatiblespec, (speckey, (speckey[0], tuple(int(k) for k in release[:-1])))
+            return
+        if not (speckey[5] and operatorstr not in {'==', '!='}): # Local versions only make sense for equality.
+            return cls.specifiers[operatorstr], speckey
+
+    @classmethod
+    def comparemarkervalues(cls, lhs, op, rhs):
+        if op in cls.specifiers or op in {'~=', '==='}:
+            specifier = cls._specifierornone(op, rhs)
+            if specifier is not None:
+                key = _versionkey(lhs)
+                return key is not None and specifier[0](lhs, key, specifier[1])
+        return cls.operators[op](lhs, rhs)
+
     @classmethod
     def parselines(cls, lines):
         def g():
             for line in lines:
                 if re.search(cls.skipregex, line) is not None:
                     continue
-                namepart, extras, versionspec = re.search(cls.getregex, line).groups()[:3]
+                groups = re.search(cls.getregex, line).groups()
+                namepart, extras, versionspec = groups[:3]
+                marker = groups[-1]
+                if marker and not _evaluatemarker(marker):
+                    continue
                 extras = () if extras is None else tuple(sorted(set(re.findall(cls.nameregex, extras)))) # TODO LATER: Normalisation.
                 versions = []
                 reqstrversions = []
                 if versionspec is not None:
-                    for onestr in versionspec.split(','):
+                    for onestr in versionspec.strip().lstrip('(').rstrip(')').split(','):
                         operatorstr, versionstr = re.search(cls.versionregex, onestr).groups()
-                        versions.append(cls.Version(cls.operators[operatorstr], cls._splitversion(versionstr)))
+                        specifier = cls._specifierornone(operatorstr, versionstr)
+                        if specifier is None:
+                            raise ValueError(onestr)
+                        versions.append(specifier)
                         reqstrversions.append(operatorstr + versionstr)
-                yield cls(namepart, extras, versions, namepart + ("[%s]" % ','.join(extras) if extras else '') + ','.join(sorted(reqstrversions)))
+                yield cls(namepart, extras, tuple(versions), namepart + ("[%s]" % ','.join(extras) if extras else '') + ','.join(sorted(reqstrversions)))
         return list(g())
 
     def __init__(self, namepart, extras, versions, reqstr):
@@ -530,9 +1661,197 @@ class FastReq:
         self.versions = versions
         self.reqstr = reqstr
 
+    @property
+    def pinned(self):
+        return any(f in {_eqspec, _arbitraryspec} for f, _ in self.versions)
+
     def acceptversion(self, versionstr):
-        splitversion = self._splitversion(versionstr)
-        return all(v.accept(splitversion) for v in self.versions)
+        key = _versionkey(versionstr)
+        return key is not None and all(f(versionstr, key, arg) for f, arg in self.versions)
+
+class WheelStore:
+
+    extraregex = r"""^\s*extra\s*==\s*(?:'[^']*'|"[^"]*")\s*$"""
+
+    @staticmethod
+    def _scriptentrypoints(entrypointslines):
+        section = None
+        for line in entrypointslines:
+            line = line.strip()
+            if line.startswith('['):
+                section = line[1:-1].strip()
+            elif line and section in {'console_scripts', 'gui_scripts'}:
+                scriptname, _, target = (w.strip() for w in line.partition('='))
+                module, _, attrs = target.split('[')[0].strip().partition(':')
+                yield scriptname, module.strip(), attrs.strip()
+
+    @classmethod
+    def _requiresornone(cls, wheelpath):
+        from zipfile import ZipFile
+        with ZipFile(wheelpath) as z:
+            name, = (n for n in z.namelist() if 1 == n.count('/') and n.endswith('.dist-info/METADATA'))
+            text = z.read(name).decode('utf-8')
+            entrypointsname = name[:-len('METADATA')] + 'entry_points.txt'
+            entrypointslines = z.read(entrypointsname).decode('utf-8').splitlines() if entrypointsname in z.namelist() else []
+        for scriptname, module, attrs in cls._scriptentrypoints(entrypointslines):
+            if not attrs:
+                log.debug("Unsupported entry point: %s", scriptname) # No callable, pip rejects these too.
+                return
+        reqstrs = []
+        for line in text.splitlines():
+            if not line:
+                break # End of headers.
+            if line.startswith('Requires-Dist:'):
+                reqstr, _, marker = line[len('Requires-Dist:'):].partition(';')
+                if marker.strip():
+                    if re.search(cls.extraregex, marker) is not None:
+                        continue
+                    log.debug("Unsupported marker: %s", marker)
+                    return
+                reqstr = re.sub(r'\((.*)\)', r'\1', reqstr)
+                if re.search(FastReq.getregex, reqstr) is None:
+                    log.debug("Unsupported requirement: %s", reqstr)
+                    return
+                reqstrs.append(reqstr)
+        return reqstrs
+
+    @classmethod
+    def resolveornone(cls, wheelhouse, reqstrs, inventory, pytags):
+        keytowheels = {}
+        for path in listorempty(wheelhouse):
+            words = os.path.basename(path).split('-')
+            if path.endswith('.whl') and len(words) in {5, 6} and ['none', 'any.whl'] == words[-2:] and pytags & set(words[-3].split('.')):
+                sortkey = _versionkey(words[1])
+                if sortkey is not None:
+                    keytowheels.setdefault(_inventorykey(words[0]), []).append((sortkey, words[1], path))
+        keytoversion = {}
+        wheelpaths = []
+        reqs = FastReq.parselines(reqstrs)
+        while reqs:
+            req = reqs.pop(0)
+            if req.extras:
+                log.debug("Unsupported extras: %s", req.reqstr)
+                return
+            key = _inventorykey(req.namepart)
+            version = keytoversion.get(key, inventory.get(key))
+            if version is not None:
+                if req.acceptversion(version):
+                    continue
+                log.debug("Conflict: %s %s", req.reqstr, version)
+                return
+            candidates = [w for w in keytowheels.get(key, []) if req.acceptversion(w[1])]
+            if not candidates:
+                log.debug("No pure wheel: %s", req.reqstr)
+                return
+            _, keytoversion[key], path = max(candidates)
+            requires = cls._requiresornone(path)
+            if requires is None:
+                return
+            reqs.extend(FastReq.parselines(requires))
+            wheelpaths.append(path)
+        return wheelpaths
+
+    def __init__(self, storedir):
+        self.storedir = storedir
+
+    def _objectpath(self, digest, x):
+        return os.path.join(self.storedir, 'objects', digest[:2], digest[2:] + x)
+
+    def _manifest(self, wheelpath):
+        manifestpath = os.path.join(self.storedir, 'wheels', os.path.basename(wheelpath))
+        try:
+            with os.fdopen(_osop(os.open, manifestpath, os.O_RDONLY)) as f:
+                return [l[:-1].split('\t', 3) for l in f]
+        except oserrors[errno.ENOENT]:
+            pass
+        from zipfile import ZipFile
+        log.debug("Unpack: %s", wheelpath)
+        entries = []
+        with ZipFile(wheelpath) as z:
+            for info in z.infolist():
+                if info.filename.endswith('/'):
+                    continue
+                data = z.read(info)
+                digest = _recorddigest(data)
+                x = 'x' if info.external_attr >> 16 & executablebits else '-'
+                objectpath = self._objectpath(digest, x)
+                if not os.path.exists(objectpath):
+                    _makedirs(os.path.dirname(objectpath))
+                    h, q = mkstemp(dir = os.path.dirname(objectpath))
+                    with _onerror(lambda: os.remove(q)):
+                        with os.fdopen(h, 'wb') as f:
+                            f.write(data)
+                        os.chmod(q, 0o755 if 'x' == x else 0o644)
+                        os.rename(q, objectpath)
+                entries.append([digest, x, str(len(data)), info.filename])
+        _makedirs(os.path.dirname(manifestpath))
+        _atomicwrite(manifestpath, ''.join("%s\n" % '\t'.join(e) for e in entries))
+        return entries
+
+    def install(self, venv, wheelpaths):
+        sitepath = venv.site_packages
+        pyname = os.path.basename(os.path.dirname(sitepath))
+        python = os.path.abspath(venv.programpath('python'))
+        def writescript(name, data):
+            path = venv.programpath(name)
+            _idempotentunlink(path)
+            with open(path, 'wb') as f:
+                f.write(data)
+            os.chmod(path, 0o755)
+            records.append([os.path.relpath(path, sitepath), _recorddigest(data), str(len(data))])
+        for wheelpath in wheelpaths:
+            log.info("Link: %s", os.path.basename(wheelpath))
+            records = []
+            distinfo = None
+            for digest, x, size, name in self._manifest(wheelpath):
+                objectpath = self._objectpath(digest, x)
+                parts = name.split('/')
+                if 2 < len(parts) and parts[0].endswith('.data'):
+                    scheme = parts[1]
+                    if 'scripts' == scheme:
+                        with open(objectpath, 'rb') as f:
+                            data = f.read()
+                        writescript(os.path.join(*parts[2:]), re.sub(b'^#!pythonw?', b'#!' + python.encode(sys.getfilesystemencoding()), data))
+                        continue
+                    target = os.path.join({
+                        'purelib': sitepath,
+                        'platlib': sitepath,
+                        'data': venv.venvpath,
+                        'headers': os.path.join(venv.venvpath, 'include', 'site', pyname, parts[0][:-len('.data')].split('-')[0]),
+                    }[scheme], *parts[2:])
+                else:
+                    target = os.path.join(sitepath, *parts)
+                    if 2 == len(parts) and parts[0].endswith('.dist-info'):
+                        distinfo = parts[0]
+                        if parts[1] in {'INSTALLER', 'RECORD'}:
+                            continue
+                _makedirs(os.path.dirname(target))
+                _idempotentunlink(target)
+                os.link(objectpath, target)
+                records.append([os.path.relpath(target, sitepath), digest, size])
+            distinfopath = os.path.join(sitepath, distinfo)
+            try:
+                with os.fdopen(_osop(os.open, os.path.join(distinfopath, 'entry_points.txt'), os.O_RDONLY)) as f:
+                    entrypointslines = f.read().splitlines()
+            except oserrors[errno.ENOENT]:
+                entrypointslines = []
+            for scriptname, module, attrs in self._scriptentrypoints(entrypointslines):
+                writescript(scriptname, ("#!%s\nimport sys\nfrom %s import %s\nif '__main__' == __name__:\n    sys.exit(%s())\n" % (python, module, attrs.split('.')[0], attrs)).encode('utf-8'))
+            installerpath = os.path.join(distinfopath, 'INSTALLER')
+            data = b'venvpool\n'
+            _idempotentunlink(installerpath) # Do not write through a link into the store.
+            with open(installerpath, 'wb') as f:
+                f.write(data)
+            records.append([os.path.relpath(installerpath, sitepath), _recorddigest(data), str(len(data))])
+            recordpath = os.path.join(distinfopath, 'RECORD')
+            records.append([os.path.relpath(recordpath, sitepath), '', ''])
+            with open(recordpath, 'w') as f:
+                for path, digest, size in records:
+                    f.write("%s,%s,%s\n" % (path, "sha256=%s" % digest if digest else '', size))
+
+def _recorddigest(data):
+    from base64 import urlsafe_b64encode
+    return urlsafe_b64encode(sha256(data).digest()).rstrip(b'=').decode('ascii')
 
 class ParsedRequires:
 
@@ -541,10 +1860,19 @@ class ParsedRequires:
     def __init__(self, requires):
         self.pypireqs = self.parselines(requires)
 
+    def fingerprint(self, interpreter):
+        reqstrs = sorted(_inventorykey(r.namepart) + r.reqstr[len(r.namepart):] for r in self.pypireqs)
+        return sha256('\n'.join([interpreter] + reqstrs).encode('utf-8')).hexdigest()
+
     def invoke(self, venv):
-        venv.install([r.reqstr for r in self.pypireqs])
+        reqstrs = [r.reqstr for r in self.pypireqs]
+        if all(r.pinned for r in self.pypireqs):
+            venv.install(reqstrs, os.path.join(pooldir, 'wheelhouse'))
+        else:
+            log.debug('Not all requirements pinned, install from index.') # Else the wheelhouse would serve whatever version it cached first.
+            venv.install(reqstrs)
 
-    def poplocalreqs(self, workspace):
+    def poplocalreqs(self, workspace, deps = None):
         local = OrderedDict()
         reqs = list(self.pypireqs)
         del self.pypireqs[:]
@@ -553,8 +1881,9 @@ class ParsedRequires:
             for req in reqs:
                 projectdir = os.path.join(workspace, req.namepart)
                 if projectdir not in local:
+                    _dependon(deps, projectdir)
                     if os.path.exists(projectdir):
-                        requirementslines = _getrequirementslinesornone(projectdir, req.extras)
+                        requirementslines = _getrequirementslinesornone(projectdir, req.extras, deps)
                         if requirementslines is None:
                             raise NoRequirementsFoundException("%s[%s]" % (projectdir, ','.join(req.extras)))
                         nextreqs.extend(self.parselines(requirementslines))
@@ -564,9 +1893,21 @@ class ParsedRequires:
             reqs = nextreqs
         return list(local)
 
-def _getrequirementslinesornone(projectdir, extras):
+def _statkey(path):
+    try:
+        st = _osop(os.stat, path)
+    except (oserrors[errno.ENOENT], oserrors[errno.ENOTDIR]):
+        return '-'
+    return "%s:%s:%r" % (st.st_ino, st.st_size, st.st_mtime)
+
+def _dependon(deps, path):
+    if deps is not None:
+        deps[path] = _statkey(path) # Before reading so that concurrent changes make it stale.
+
+def _getrequirementslinesornone(projectdir, extras, deps = None):
     def linesornone(acceptnull, *names):
         path = os.path.join(projectdir, *names)
+        _dependon(deps, path)
         if os.path.exists(path):
             log.debug("Found requirements: %s", path)
             with open(path) as f:
@@ -579,6 +1920,7 @@ def _getrequirementslinesornone(projectdir, extras):
     v = linesornone(False, 'requirements.txt')
     if v is not None:
         return v
+    _dependon(deps, projectdir)
     names = [name for name in os.listdir(projectdir) if name.endswith('.egg-info')]
     if names:
         name, = names # XXX: Could there legitimately be multiple?
@@ -607,9 +1949,9 @@ class ParserCommand:
 
 class NoRequirementsFoundException(Exception): pass
 
-def _findrequirements(projectdir):
+def _findrequirements(projectdir, deps = None):
     while True:
-        requirementslines = _getrequirementslinesornone(projectdir, ())
+        requirementslines = _getrequirementslinesornone(projectdir, (), deps)
         if requirementslines is not None:
             return projectdir, requirementslines
         parent = os.path.dirname(projectdir)
@@ -617,6 +1959,47 @@ def _findrequirements(projectdir):
             raise NoRequirementsFoundException
         projectdir = parent
 
+class Resolution:
+
+    def __init__(self, scriptpath):
+        from binascii import crc32 # Much cheaper than hashlib.
+        self.path = os.path.join(pooldir, 'launch', "%08x" % (crc32(scriptpath.encode('utf-8')) & 0xffffffff))
+        self.scriptpath = scriptpath
+
+    def loadornone(self):
+        try:
+            with os.fdopen(_osop(os.open, self.path, os.O_RDONLY)) as f:
+                lines = f.read().splitlines()
+        except oserrors[errno.ENOENT]:
+            return
+        if lines[0] != self.scriptpath:
+            log.debug("Other script: %s", lines[0])
+            return
+        kindtovalues = dict(d = [], i = [], l = [], m = [], r = [])
+        for l in lines[1:]:
+            kind, value = l.split('\t', 1)
+            kindtovalues[kind].append(value)
+        if kindtovalues['i'] != [self._interpreter()]:
+            log.debug("Other interpreter: %s", kindtovalues['i'])
+            return
+        for dep in kindtovalues['d']:
+            key, path = dep.split('\t', 1)
+            if _statkey(path) != key:
+                log.debug("Stale: %s", path)
+                return
+        module, = kindtovalues['m']
+        return kindtovalues['l'], module, kindtovalues['r']
+
+    @staticmethod
+    def _interpreter():
+        return "%s\t%s" % (sys.executable, '.'.join(map(str, sys.version_info))) # Requirement markers may depend on it.
+
+    def save(self, deps, localreqs, module, requires):
+        _makedirs(os.path.dirname(self.path))
+        _atomicwrite(self.path, ''.join("%s\n" % l for l in [self.scriptpath, "i\t%s" % self._interpreter()] + [
+            "d\t%s\t%s" % (key, path) for path, key in deps.items()
+        ] + ["l\t%s" % p for p in localreqs] + ["m\t%s" % module] + ["r\t%s" % r for r in requires]))
+
 @_shortcut
 class Launch(ParserCommand):
 
@@ -636,18 +2019,36 @@ class Launch(ParserCommand):
         reqstr = args.req
         if reqstr is None:
             scriptpath = os.path.abspath(scriptpath) # XXX: Is abspath safe when scriptpath has symlinks?
-            projectdir, requirementslines = _findrequirements(os.path.dirname(scriptpath))
-            installdeps = ParsedRequires(requirementslines)
-            localreqs = installdeps.poplocalreqs(os.path.normpath(os.path.join(projectdir, '..')))
-            localreqs.insert(0, projectdir)
-            module = os.path.relpath(scriptpath[:-len(dotpy)], projectdir).replace(os.sep, '.')
+            resolution = Resolution(scriptpath)
+            t = resolution.loadornone()
+            localreqs, module, requires = cls._resolve(resolution) if t is None else t
+            installdeps = ParsedRequires(requires)
         else:
             installdeps = ParsedRequires([reqstr])
             localreqs = []
             module = scriptpath[:-len(dotpy)].replace(os.sep, '.')
         with Pool(sys.version_info.major).readonly(installdeps) as venv: # TODO: Likely to be major 2 when launching manually.
+            idle = os.environ.get('VENVPOOL_ZYGOTE')
+            if idle and sys.version_info.major >= 3: # Zygote needs sendmsg, fsencode and pass_fds.
+                status = venv.callzygoteornone(localreqs, module, args.scriptarg)
+                if status is not None:
+                    sys.exit(status)
+                venv.startzygote(float(idle))
             venv.run('exec', localreqs, module, args.scriptarg)
 
+    @staticmethod
+    def _resolve(resolution):
+        scriptpath = resolution.scriptpath
+        deps = OrderedDict()
+        projectdir, requirementslines = _findrequirements(os.path.dirname(scriptpath), deps)
+        installdeps = ParsedRequires(requirementslines)
+        localreqs = installdeps.poplocalreqs(os.path.normpath(os.path.join(projectdir, '..')), deps)
+        localreqs.insert(0, projectdir)
+        module = os.path.relpath(scriptpath[:-len(dotpy)], projectdir).replace(os.sep, '.')
+        requires = [r.reqstr for r in installdeps.pypireqs]
+        resolution.save(deps, localreqs, module, requires)
+        return localreqs, module, requires
+
 class Activate(ParserCommand):
 
     help = 'create and maintain wrapper scripts'
@@ -659,28 +2060,56 @@ class Activate(ParserCommand):
         for cls in propersubcommands:
             group.add_argument('-' + cls.letter, action = 'store_true', help = 'subcommand to ' + cls.help)
         parser.add_argument('-f', action = 'store_true', help = 'overwrite existing scripts')
+        parser.add_argument('--source', dest = 'compiled', action = 'store_false', help = sourcehelp)
         parser.add_argument('projectdir', nargs = '*', default = ['.'], help = 'projects to search for runnable modules')
 
     @classmethod
     def mainimpl(cls, args):
         for projectdir in args.projectdir:
             try:
-                cls._scan(_findrequirements(os.path.realpath(projectdir))[0], 3, args.f) # XXX: Always 3?
+                cls._scan(_findrequirements(os.path.realpath(projectdir))[0], 3, args.f, args.compiled) # XXX: Always 3?
             except NoRequirementsFoundException:
                 log.exception("Skip: %s", projectdir)
 
     @staticmethod
     def _srcpaths(rootdir):
+        from binascii import crc32
+        cachepath = os.path.join(pooldir, 'scan', "%08x" % (crc32(rootdir.encode('utf-8')) & 0xffffffff))
+        cache = {}
+        try:
+            with os.fdopen(_osop(os.open, cachepath, os.O_RDONLY)) as f:
+                if f.readline()[:-1] == rootdir:
+                    for l in f:
+                        key, flag, path = l[:-1].split('\t', 2)
+                        cache[path] = key, flag
+        except oserrors[errno.ENOENT]:
+            pass
+        paths = []
         for dirpath, dirnames, filenames in os.walk(rootdir):
-            for name in filenames:
-                if name.endswith(dotpy):
-                    path = os.path.join(dirpath, name)
-                    with open(path) as f:
-                        if re.search(scriptregex, f.read(), re.MULTILINE) is not None:
-                            yield path
+            dirnames[:] = sorted(n for n in dirnames if os.path.exists(os.path.join(dirpath, n, '__init__.py'))) # Otherwise rejected by checkpath.
+            paths.extend(os.path.join(dirpath, n) for n in sorted(filenames) if n.endswith(dotpy))
+        keys = [_statkey(p) for p in paths] # Before scanning so that concurrent changes make it stale.
+        unscanned = [p for p, k in zip(paths, keys) if cache.get(p, (None,))[0] != k]
+        if unscanned:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool()
+            try:
+                flags = pool.map(_isscript, unscanned)
+            finally:
+                pool.close()
+                pool.join()
+            for p, flag in zip(unscanned, flags):
+                cache[p] = None, '1' if flag else ''
+        flags = [cache[p][1] for p in paths]
+        if unscanned or len(cache) != len(paths):
+            _makedirs(os.path.dirname(cachepath))
+            _atomicwrite(cachepath, ''.join("%s\n" % l for l in [rootdir] + ["%s\t%s\t%s" % t for t in zip(keys, flags, paths)]))
+        for p, flag in zip(paths, flags):
+            if flag:
+                yield p
 
     @classmethod
-    def _scan(cls, projectdir, pyversion, force):
+    def _scan(cls, projectdir, pyversion, force, compiled):
         for srcpath in cls._srcpaths(projectdir):
             if not checkpath(projectdir, srcpath):
                 log.debug("Not a project source file: %s", srcpath)
@@ -689,10 +2118,10 @@ class Activate(ParserCommand):
             if command is None:
                 log.debug("Bad source name: %s", srcpath)
                 continue
-            cls.install(force, command, pyversion, None, srcpath)
+            cls.install(force, compiled, command, pyversion, None, srcpath)
 
     @staticmethod
-    def install(force, command, pyversion, reqstrornone, *words):
+    def install(force, compiled, command, pyversion, reqstrornone, *words):
         def allwords():
             if reqstrornone is not None:
                 yield '--req'
@@ -700,30 +2129,52 @@ class Activate(ParserCommand):
             yield '--'
             for w in words:
                 yield w
-        def identical():
+        def existingtext():
             mode = os.stat(scriptpath).st_mode
             if mode | executablebits == mode:
                 with open(scriptpath) as f:
-                    return f.read() == text
+                    return f.read()
         wordsrepr = ', '.join(map(repr, allwords()))
         venvpoolpath = _stripc(os.path.realpath(__file__))
-        text = """#!/usr/bin/env python{pyversion}
+        parentpath = os.path.dirname(os.path.dirname(venvpoolpath))
+        texts = {
+            True: """#!/usr/bin/env python{pyversion}
+import sys
+sys.argv[1:1] = '-L', {wordsrepr}
+sys.path.insert(0, {parentpath!r})
+import venvpool
+del sys.path[0]
+venvpool.main()
+""".format(**locals()),
+            False: """#!/usr/bin/env python{pyversion}
 import sys
 sys.argv[1:1] = '-L', {wordsrepr}
 __file__ = {venvpoolpath!r}
 with open(__file__) as f: venvpoolsrc = f.read()
 del sys, f
 exec(venvpoolsrc)
-""".format(**locals())
+""".format(**locals()),
+        }
+        text = texts[compiled]
+        if compiled:
+            import py_compile
+            try:
+                py_compile.compile(venvpoolpath, doraise = True)
+            except OSError:
+                log.warning("Bytecode cache not writable for: %s", venvpoolpath, exc_info = True)
         scriptpath = os.path.join(userbin, command) # TODO: Warn if shadowed.
         if os.path.exists(scriptpath):
-            if identical():
+            existing = existingtext()
+            if existing == text:
                 log.debug("Identical: %s", scriptpath)
                 return
-            if not force:
+            if existing == texts[not compiled]:
+                log.info("Switch stub: %s", scriptpath)
+            elif not force:
                 log.info("Exists: %s", scriptpath)
                 return
-            log.info("Overwrite: %s", scriptpath)
+            else:
+                log.info("Overwrite: %s", scriptpath)
         else:
             log.info("Create: %s", scriptpath)
         with open(scriptpath, 'w') as f:
@@ -738,6 +2189,14 @@ def checkpath(projectdir, path):
         if not os.path.exists(os.path.join(path, '__init__.py')): # XXX: What about namespace packages?
             break
 
+def _isscript(path):
+    search = re.compile(scriptregex).search
+    with open(path) as f:
+        for line in f:
+            if search(line) is not None:
+                return True
+    return False
+
 def commandornone(srcpath):
     name = os.path.basename(srcpath)
     name = os.path.basename(os.path.dirname(srcpath)) if '__init__.py' == name else name[:-len(dotpy)]
@@ -752,44 +2211,239 @@ class Compact(ParserCommand):
 
     @staticmethod
     def initparser(parser):
-        pass
+        parser.add_argument('--merge', action = 'store_true', help = 'replace venvs that have no conflicting packages with one venv')
 
     @classmethod
-    def mainimpl(cls, args): # XXX: Combine venvs with orthogonal dependencies?
+    def mainimpl(cls, args):
+        from multiprocessing.pool import ThreadPool
         venvtofreeze = {}
         try:
-            for versiondir in listorempty(pooldir):
-                for venv in listorempty(versiondir, Venv):
-                    if venv.trywritelock():
-                        venvtofreeze[venv] = set(subprocess.check_output([venv.programpath('pip'), 'freeze'], universal_newlines = True).splitlines())
-                    else:
-                        log.debug("Busy: %s", venv.venvpath)
+            with sweeppass():
+                for versiondir in _versiondirs():
+                    for venv in listorempty(versiondir, Venv):
+                        if venv.trywritelock():
+                            venvtofreeze[venv] = None
+                        else:
+                            log.debug("Busy: %s", venv.venvpath)
+            venvs = list(venvtofreeze)
+            pool = ThreadPool()
+            try:
+                for venv, freeze in zip(venvs, pool.map(cls._freeze, venvs)):
+                    venvtofreeze[venv] = freeze
+            finally:
+                pool.close()
+                pool.join()
             log.debug('Find redundant venvs.')
-            while True:
-                venv = cls._redundantvenv(venvtofreeze)
-                if venv is None:
-                    break
+            for venv in cls._redundantvenvs(venvtofreeze):
                 venv.delete('redundant')
                 venvtofreeze.pop(venv)
+            if args.merge:
+                cls._mergevenvs(venvtofreeze)
             cls._compactvenvs([l.venvpath for l in venvtofreeze])
+            _prunebookkeeping()
         finally:
             for l in venvtofreeze:
                 l.writeunlock()
 
     @staticmethod
-    def _redundantvenv(venvtofreeze):
-        for venv, freeze in venvtofreeze.items():
-            for othervenv, otherfreeze in venvtofreeze.items():
-                if venv != othervenv and os.path.dirname(venv.venvpath) == os.path.dirname(othervenv.venvpath) and freeze <= otherfreeze:
-                    return venv
+    def _freeze(venv, excluded = frozenset(['distribute', 'pip', 'setuptools', 'wheel'])): # As pip freeze.
+        return set("%s==%s" % t for t in venv.inventory().items() if t[0] not in excluded)
+
+    @staticmethod
+    def _redundantvenvs(venvtofreeze):
+        redundant = []
+        versiondirtoindex = {}
+        # A subset of a redundant venv is a subset of whatever made it redundant, so only check against kept venvs:
+        for venv, freeze in sorted(venvtofreeze.items(), key = lambda t: (-len(t[1]), t[0].venvpath)):
+            kept, index = versiondirtoindex.setdefault(os.path.dirname(venv.venvpath), ([], {}))
+            supersets = set(kept)
+            for item in sorted(freeze, key = lambda item: len(index.get(item, ()))):
+                if not supersets:
+                    break
+                supersets.intersection_update(index.get(item, ()))
+            if supersets:
+                redundant.append(venv)
+            else:
+                kept.append(venv)
+                for item in freeze:
+                    index.setdefault(item, set()).add(venv)
+        return redundant
+
+    @staticmethod
+    def _mergegroups(venvtofreeze):
+        versiondirtogroups = {}
+        for venv, freeze in sorted(venvtofreeze.items(), key = lambda t: (-len(t[1]), t[0].venvpath)):
+            pins = dict(item.split('==', 1) for item in freeze)
+            groups = versiondirtogroups.setdefault(os.path.dirname(venv.venvpath), [])
+            for venvs, grouppins in groups:
+                if all(grouppins.get(name, version) == version for name, version in pins.items()):
+                    venvs.append(venv)
+                    grouppins.update(pins)
+                    break
+            else:
+                groups.append(([venv], pins))
+        return [(venvs, pins) for groups in versiondirtogroups.values() for venvs, pins in groups if 1 < len(venvs)]
+
+    @classmethod
+    def _mergevenvs(cls, venvtofreeze):
+        for venvs, pins in cls._mergegroups(venvtofreeze):
+            log.info("Merge %s venvs.", len(venvs))
+            try:
+                venv = Pool(int(os.path.basename(os.path.dirname(venvs[0].venvpath))))._newvenv(ParsedRequires(["%s==%s" % t for t in sorted(pins.items())]))
+            except Exception:
+                log.warning('Failed to merge venvs, keep them.', exc_info = True)
+                continue
+            venvtofreeze[venv] = cls._freeze(venv) # Stays write locked until compaction is done.
+            for v in venvs:
+                v.delete('merged')
+                venvtofreeze.pop(v)
 
     @staticmethod
     def _compactvenvs(venvpaths):
         log.info("Compact %s venvs.", len(venvpaths))
-        if venvpaths:
-            subprocess.check_call(['jdupes', '-Lrq'] + venvpaths)
+        indexpath = os.path.join(pooldir, 'dedup')
+        try:
+            with os.fdopen(_osop(os.open, indexpath, os.O_RDONLY)) as f:
+                keytodigest = dict(l.split() for l in f)
+        except oserrors[errno.ENOENT]:
+            keytodigest = {}
+        pathtost = {}
+        for venvpath in venvpaths:
+            for dirpath, dirnames, filenames in os.walk(venvpath):
+                for name in filenames:
+                    path = os.path.join(dirpath, name)
+                    st = os.lstat(path)
+                    if S_ISREG(st.st_mode) and st.st_size: # Lock files are empty.
+                        pathtost[path] = st
+        statkey = lambda st: "%s:%s:%s:%r" % (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+        unhashed = sorted(set(p for p, st in pathtost.items() if statkey(st) not in keytodigest))
+        log.debug("Hash %s of %s files.", len(unhashed), len(pathtost))
+        if len(unhashed) < 100:
+            digests = [_filedigest(p) for p in unhashed]
+        else:
+            import multiprocessing
+            pool = multiprocessing.Pool()
+            try:
+                digests = pool.map(_filedigest, unhashed, 100)
+            finally:
+                pool.close()
+                pool.join()
+        for path, digest in zip(unhashed, digests):
+            keytodigest[statkey(pathtost[path])] = digest
+        groups = {}
+        for path, st in pathtost.items():
+            groups.setdefault((keytodigest[statkey(st)], st.st_size, st.st_dev, st.st_mode, st.st_uid, st.st_gid), []).append(path)
+        linkcount = 0
+        for paths in groups.values():
+            canonical = max(paths, key = lambda p: (pathtost[p].st_nlink, p)) # Prefer an inode that is already widely shared.
+            ino = pathtost[canonical].st_ino
+            for path in paths:
+                if pathtost[path].st_ino != ino:
+                    linkpath = "%s.%s" % (path, os.getpid())
+                    os.link(canonical, linkpath)
+                    os.rename(linkpath, path)
+                    pathtost[path] = pathtost[canonical]
+                    linkcount += 1
+        log.debug("Replaced %s files with hardlinks.", linkcount)
+        if pathtost:
+            _atomicwrite(indexpath, ''.join("%s %s\n" % (key, keytodigest[key]) for key in sorted(set(statkey(st) for st in pathtost.values()))))
         log.info('Compaction complete.')
 
+@_shortcut
+class Spare(ParserCommand):
+
+    help = 'keep bootstrapped empty venvs ready for new requirements'
+    letter = 'P'
+
+    @staticmethod
+    def initparser(parser):
+        parser.add_argument('-n', type = int, help = 'number of spare venvs to keep, otherwise as last given')
+        parser.add_argument('--pyversion', type = int, default = 3, help = 'major version of python')
+
+    @classmethod
+    def mainimpl(cls, args):
+        Pool(args.pyversion).fillspares(args.n)
+
+@_shortcut
+class Evict(ParserCommand):
+
+    help = 'delete least recently used venvs until within budget'
+    letter = 'E'
+
+    @staticmethod
+    def initparser(parser):
+        parser.add_argument('--bytes', type = int, default = os.environ.get('VENVPOOL_EVICT_BYTES'), help = 'disk usage to get within, counting each hardlinked file once')
+        parser.add_argument('--count', type = int, default = os.environ.get('VENVPOOL_EVICT_COUNT'), help = 'number of venvs to get within')
+
+    @classmethod
+    def mainimpl(cls, args):
+        venvs = [venv for versiondir in _versiondirs() for venv in listorempty(versiondir, Venv)]
+        lastuse = {venv: venv.lastuse() for venv in venvs}
+        locked = []
+        try:
+            with sweeppass():
+                for venv in venvs:
+                    if venv.trywritelock():
+                        locked.append(venv)
+                    else:
+                        log.debug("Busy: %s", venv.venvpath)
+            for venv in cls._evictees(venvs, locked, args.bytes, args.count, lastuse):
+                venv.delete('evicted')
+                locked.remove(venv)
+            _prunebookkeeping()
+        finally:
+            for venv in locked:
+                venv.writeunlock()
+
+    @staticmethod
+    def _links(venvpath):
+        links = {}
+        for dirpath, dirnames, filenames in os.walk(venvpath):
+            for name in filenames:
+                try:
+                    st = _osop(os.lstat, os.path.join(dirpath, name))
+                except oserrors[errno.ENOENT]:
+                    continue
+                if S_ISREG(st.st_mode):
+                    key = st.st_dev, st.st_ino
+                    n, nlink, size = links.get(key, (0, st.st_nlink, st.st_blocks * 512))
+                    links[key] = n + 1, nlink, size
+        return links
+
+    @classmethod
+    def _evictees(cls, venvs, locked, maxbytes, maxcount, lastuse):
+        venvtolinks = {venv: cls._links(venv.venvpath) for venv in venvs}
+        inodetonlink = {}
+        inodetosize = {}
+        for links in venvtolinks.values():
+            for key, (_, nlink, size) in links.items():
+                inodetonlink[key] = nlink
+                inodetosize[key] = size
+        usage = sum(inodetosize.values())
+        count = len(venvs)
+        log.info("Pool has %s venvs using %s bytes.", count, usage)
+        overbytes = lambda: maxbytes is not None and usage > maxbytes
+        overcount = lambda: maxcount is not None and count > maxcount
+        evictable = sorted(locked, key = lambda venv: lastuse[venv])
+        progress = True
+        while progress and (overbytes() or overcount()):
+            progress = False
+            for venv in list(evictable):
+                if not (overbytes() or overcount()):
+                    break
+                links = venvtolinks[venv]
+                freed = sum(inodetosize[key] for key, (n, _, _) in links.items() if inodetonlink[key] == n)
+                if not (freed or overcount()):
+                    continue # Would free nothing, but may once a venv it shares with is gone.
+                for key, (n, _, _) in links.items():
+                    inodetonlink[key] -= n
+                usage -= freed
+                count -= 1
+                evictable.remove(venv)
+                progress = True
+                log.debug("Evict to free %s bytes: %s", freed, venv.venvpath)
+                yield venv
+
 @_shortcut
 class Unlock(ParserCommand):
 
@@ -802,7 +2456,7 @@ class Unlock(ParserCommand):
 
     @classmethod
     def mainimpl(cls, args):
-        for versiondir in listorempty(pooldir):
+        for versiondir in _versiondirs():
             for venv in listorempty(versiondir, Venv):
                 try:
                     venv.writeunlock()
@@ -820,6 +2474,7 @@ class ConsoleScripts(ParserCommand):
     @staticmethod
     def initparser(parser):
         parser.add_argument('-f', action = 'store_true', help = 'overwrite existing scripts')
+        parser.add_argument('--source', dest = 'compiled', action = 'store_false', help = sourcehelp)
         parser.add_argument('spec', help = 'a requirement specifier')
 
     @classmethod
@@ -833,7 +2488,7 @@ class ConsoleScripts(ParserCommand):
             with Pool(pyversion).readonly(ParsedRequires(['importlib-metadata', spec.reqstr])) as venv:
                 names = set(venv.run('check_output', [tempdir], 'list', [], universal_newlines = True).splitlines())
         for name in names:
-            Activate.install(args.f, name, pyversion, spec.reqstr, chainrelpath, name)
+            Activate.install(args.f, args.compiled, name, pyversion, spec.reqstr, chainrelpath, name)
 
     @staticmethod
     def _commands(distname):